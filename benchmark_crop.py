@@ -0,0 +1,58 @@
+import sys
+import time
+import pydicom
+import cv2
+from dicom_scan import scan_dicom
+from dicom_to_png import png_array
+
+
+def encode(dicom_image, crop):
+    """ Convert and encode one image to .png in memory. Returns (seconds, encoded bytes, pixels encoded) """
+    start = time.perf_counter()
+    pixel_array, _ = png_array(dicom_image, crop)
+    ok, encoded = cv2.imencode('.png', pixel_array)
+    elapsed = time.perf_counter() - start
+    if not ok:
+        raise ValueError("PNG encoding failed")
+    return elapsed, len(encoded), pixel_array.size
+
+
+def benchmark(dicom_folder, limit=None):
+    """ Compare normalization + PNG encoding time and size of full frames with breast-cropped frames """
+    totals = {False: [0.0, 0, 0], True: [0.0, 0, 0]}
+    count = 0
+    for dicom_path in scan_dicom(dicom_folder):
+        if limit is not None and count >= limit:
+            break
+        try:
+            dicom_image = pydicom.dcmread(dicom_path)
+            dicom_image.pixel_array  # decode once, so both variants measure the same work
+            results = {crop: encode(dicom_image, crop) for crop in (False, True)}
+        except Exception as e:
+            print(f"Failed to process {dicom_path}: {e}")
+            continue
+        for crop, result in results.items():
+            for i, value in enumerate(result):
+                totals[crop][i] += value
+        count += 1
+        full, cropped = results[False], results[True]
+        print(f"{dicom_path}: {full[1] / 1024:.0f} KiB -> {cropped[1] / 1024:.0f} KiB, "
+              f"{full[0] * 1000:.0f} ms -> {cropped[0] * 1000:.0f} ms, "
+              f"{100 * (1 - cropped[2] / full[2]):.0f}% of pixels removed")
+
+    if not count:
+        print("No DICOM files processed.")
+        return
+    full, cropped = totals[False], totals[True]
+    print(f"\n{count} images")
+    print(f"Pixels removed: {100 * (1 - cropped[2] / full[2]):.1f}%")
+    print(f"Encode time:    {full[0]:.2f} s -> {cropped[0]:.2f} s ({100 * (1 - cropped[0] / full[0]):.1f}% saved)")
+    print(f"Object size:    {full[1] / 2**20:.1f} MiB -> {cropped[1] / 2**20:.1f} MiB "
+          f"({100 * (1 - cropped[1] / full[1]):.1f}% saved)")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        benchmark(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    else:
+        print("Usage: python3 benchmark_crop.py <dicom_folder> [<max_images>]")
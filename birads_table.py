@@ -0,0 +1,71 @@
+import os
+import sys
+import hashlib
+import pandas as pd
+
+
+# Only these columns of the BIRADS Excel exports are used by the scripts
+BIRADS_COLUMNS = ['JMBG', 'Vreme kreiranja', 'BIRADS L', 'BIRADS D']
+CACHE_VERSION = 1  # bump when BIRADS_COLUMNS or _normalize change, so older cached tables are not served
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.birads_cache')
+
+
+def file_hash(file_path):
+    """ SHA-256 of the file contents, used as the cache key so an edited export is never served from cache """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _normalize(df):
+    """ Normalize column types once: JMBG and BIRADS as stripped strings, 'Vreme kreiranja' as datetime """
+    df['JMBG'] = df['JMBG'].fillna('').astype(str).str.strip()
+    df['Vreme kreiranja'] = pd.to_datetime(df['Vreme kreiranja'], errors='coerce')
+    for column in ('BIRADS L', 'BIRADS D'):
+        df[column] = df[column].fillna('').astype(str).str.strip()
+    return df
+
+
+def load_birads_table(xls_path, cache_dir=None):
+    """ Load the BIRADS columns of an Excel export.
+        The normalized table is cached as Parquet keyed by the file hash and CACHE_VERSION, so only the first run
+        parses the Excel file. cache_dir defaults to the BIRADS_CACHE_DIR environment variable (read on every call,
+        so the dicomtk daemon follows the caller's environment) or DEFAULT_CACHE_DIR
+    """
+    cache_dir = cache_dir or os.getenv('BIRADS_CACHE_DIR') or DEFAULT_CACHE_DIR
+    cache_path = os.path.join(cache_dir, f'v{CACHE_VERSION}-{file_hash(xls_path)}.parquet')
+    if os.path.exists(cache_path):
+        try:
+            return pd.read_parquet(cache_path)
+        except Exception as e:
+            print(f"Could not read cached BIRADS table {cache_path}: {e}")
+
+    df = pd.read_excel(xls_path, usecols=BIRADS_COLUMNS, dtype={'JMBG': str, 'BIRADS L': str, 'BIRADS D': str})
+    df = _normalize(df)
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, cache_path)
+    except ImportError:
+        print("pyarrow is not installed, the BIRADS table will not be cached.")
+    except OSError as e:
+        print(f"Could not cache BIRADS table: {e}")
+    return df
+
+
+def birads_map(df):
+    """ Map PatientID (JMBG) to (BIRADS L, BIRADS D) """
+    return dict(zip(df['JMBG'], zip(df['BIRADS L'], df['BIRADS D'])))
+
+
+if __name__ == '__main__':
+    # Warm the cache, e.g. right after a new export lands
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            print(f"{path}: {len(load_birads_table(path))} rows")
+    else:
+        print("Please provide BIRADS Excel file(s).")
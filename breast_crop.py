@@ -0,0 +1,94 @@
+import numpy as np
+import cv2
+
+
+DEFAULT_DOWNSAMPLE = 8  # the mask is computed on an image this many times smaller in each direction
+DEFAULT_MARGIN = 2      # margin around the breast, in downsampled pixels
+
+
+def tissue_mask(pixel_array, downsample=DEFAULT_DOWNSAMPLE, monochrome1=False):
+    """ Boolean mask of the breast on a downsampled copy of the image (Otsu threshold, largest connected component,
+        so labels and markers are dropped). Returns None if no tissue was found
+    """
+    rows, columns = pixel_array.shape[:2]
+    small = cv2.resize(pixel_array.astype(np.float32),
+                       (max(1, columns // downsample), max(1, rows // downsample)),
+                       interpolation=cv2.INTER_AREA)
+    low, high = float(small.min()), float(small.max())
+    if high <= low:
+        return None
+    small = ((small - low) / (high - low) * 255.0).astype(np.uint8)
+    if monochrome1:  # MONOCHROME1: background is bright
+        small = 255 - small
+
+    _, mask = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    if count <= 1:
+        return None
+    largest = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
+    return labels == largest
+
+
+def breast_bbox(pixel_array, laterality=None, monochrome1=False, downsample=DEFAULT_DOWNSAMPLE,
+                margin=DEFAULT_MARGIN):
+    """ Bounding box (x, y, width, height) of the breast in full resolution pixels, and the downsampled tissue mask.
+        The box always extends to the chest wall edge. That edge is the image side the tissue touches most; if the
+        mask does not tell, ImageLaterality decides (L: left edge, R: right edge). Returns (None, None) if no tissue
+        was found
+    """
+    mask = tissue_mask(pixel_array, downsample, monochrome1)
+    if mask is None:
+        return None, None
+    rows, columns = pixel_array.shape[:2]
+    small_rows, small_columns = mask.shape
+    scale_y, scale_x = rows / small_rows, columns / small_columns
+
+    ys, xs = np.nonzero(mask)
+    x0, x1 = max(0, xs.min() - margin), min(small_columns, xs.max() + 1 + margin)
+    y0, y1 = max(0, ys.min() - margin), min(small_rows, ys.max() + 1 + margin)
+
+    left_edge, right_edge = int(mask[:, 0].sum()), int(mask[:, -1].sum())
+    laterality = str(laterality or '').strip().upper()
+    if left_edge > right_edge or (left_edge == right_edge and laterality == 'L'):
+        x0 = 0
+    elif right_edge > left_edge or (left_edge == right_edge and laterality == 'R'):
+        x1 = small_columns
+
+    x, y = int(x0 * scale_x), int(y0 * scale_y)
+    width = min(columns, int(np.ceil(x1 * scale_x))) - x
+    height = min(rows, int(np.ceil(y1 * scale_y))) - y
+    return (x, y, width, height), mask
+
+
+def crop_and_normalize(pixel_array, box, mask):
+    """ Crop pixel_array to box and normalize it to 0-255 (uint8) using the intensity range of the tissue only """
+    x, y, width, height = box
+    cropped = pixel_array[y:y + height, x:x + width].astype(np.float32)
+
+    # Map the tissue mask onto the crop to compute the normalization statistics. The mask is eroded first so that
+    # background pixels at the skin line do not end up in the statistics
+    rows, columns = pixel_array.shape[:2]
+    small_rows, small_columns = mask.shape
+    sx0, sx1 = int(x * small_columns / columns), int(np.ceil((x + width) * small_columns / columns))
+    sy0, sy1 = int(y * small_rows / rows), int(np.ceil((y + height) * small_rows / rows))
+    small_tissue = cv2.erode(mask[sy0:sy1, sx0:sx1].astype(np.uint8), np.ones((3, 3), np.uint8))
+    tissue = cv2.resize(small_tissue, (width, height), interpolation=cv2.INTER_NEAREST).astype(bool)
+
+    values = cropped[tissue] if tissue.any() else cropped
+    low, high = float(values.min()), float(values.max())
+    if high <= low:
+        return np.zeros(cropped.shape, dtype=np.uint8)
+    return (np.clip((cropped - low) / (high - low), 0.0, 1.0) * 255.0).astype(np.uint8)
+
+
+def format_crop_box(box, rows, columns):
+    """ Crop box as stored with the metadata: 'x,y,width,height,rows,columns' (enough to undo the crop) """
+    return ','.join(str(int(v)) for v in (*box, rows, columns))
+
+
+def uncrop(cropped, crop_box):
+    """ Place a cropped image back into an empty frame of the original size """
+    x, y, width, height, rows, columns = (int(v) for v in crop_box.split(','))
+    frame = np.zeros((rows, columns) + cropped.shape[2:], dtype=cropped.dtype)
+    frame[y:y + height, x:x + width] = cropped
+    return frame
@@ -0,0 +1,131 @@
+import os
+import sys
+import json
+import shutil
+import time
+from datetime import datetime, timedelta
+
+
+CACHE_VERSION = 2  # rows are single images (with instance UIDs) instead of per patient/day counts
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cfind_cache')
+DEFAULT_SETTLE_DAYS = 3     # a day queried at least this many days after it happened is not queried again
+DEFAULT_TTL_HOURS = 12      # how long results for a not yet settled day are reused
+
+
+def cache_location(cache_dir=None):
+    """ cache_dir, or the CFIND_CACHE_DIR environment variable, or DEFAULT_CACHE_DIR.
+        Read on every call, so a long-running process (the dicomtk daemon) follows the caller's environment
+    """
+    return cache_dir or os.getenv('CFIND_CACHE_DIR') or DEFAULT_CACHE_DIR
+
+
+def _day_path(cache_dir, level, sop_class, day):
+    """ Path of the cache file for a single (query level, SOP class, day) key """
+    return os.path.join(cache_dir, level, sop_class, f'{day}.json')
+
+
+def days_between(start_date, end_date):
+    """ List all days between start_date and end_date (inclusive, YYYYMMDD strings) """
+    current = datetime.strptime(start_date, '%Y%m%d')
+    end = datetime.strptime(end_date, '%Y%m%d')
+    days = []
+    while current <= end:
+        days.append(current.strftime('%Y%m%d'))
+        current += timedelta(days=1)
+    return days
+
+
+def day_ranges(days):
+    """ Group sorted YYYYMMDD days into contiguous (start, end) ranges so each range needs a single C-FIND """
+    ranges = []
+    for day in sorted(days):
+        if ranges and datetime.strptime(day, '%Y%m%d') - datetime.strptime(ranges[-1][1], '%Y%m%d') == timedelta(days=1):
+            ranges[-1][1] = day
+        else:
+            ranges.append([day, day])
+    return [tuple(r) for r in ranges]
+
+
+def load_day(level, sop_class, day, cache_dir=None):
+    """ Return the cache entry for a day or None if it is missing, unreadable or from an older cache version """
+    cache_dir = cache_location(cache_dir)
+    try:
+        with open(_day_path(cache_dir, level, sop_class, day)) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if entry.get('version') != CACHE_VERSION:
+        return None
+    return entry
+
+
+def save_day(level, sop_class, day, rows, cache_dir=None):
+    """ Store the C-FIND rows of a day. The file is replaced atomically so concurrent runs never see partial data """
+    path = _day_path(cache_location(cache_dir), level, sop_class, day)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    entry = {'version': CACHE_VERSION, 'fetched_at': time.time(), 'rows': rows}
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(entry, f)
+    os.replace(tmp_path, path)
+
+
+def is_fresh(entry, day, settle_days=DEFAULT_SETTLE_DAYS, ttl_hours=DEFAULT_TTL_HOURS, now=None):
+    """ A cached day is fresh if it was fetched after the day settled, or if it was fetched within the TTL """
+    if entry is None:
+        return False
+    now = now or datetime.now()
+    fetched_at = datetime.fromtimestamp(entry['fetched_at'])
+    if (fetched_at.date() - datetime.strptime(day, '%Y%m%d').date()).days >= settle_days:
+        return True
+    return now - fetched_at < timedelta(hours=ttl_hours)
+
+
+def stale_days(level, sop_class, days, settle_days=DEFAULT_SETTLE_DAYS, ttl_hours=DEFAULT_TTL_HOURS,
+               cache_dir=None):
+    """ Return the days that have to be queried from PACS again (missing, expired or not yet settled) """
+    now = datetime.now()
+    return [day for day in days
+            if not is_fresh(load_day(level, sop_class, day, cache_dir), day, settle_days, ttl_hours, now)]
+
+
+def invalidate(level=None, sop_class=None, days=None, cache_dir=None):
+    """ Remove cached results. Without arguments the whole cache is dropped, otherwise only the matching days """
+    cache_dir = cache_location(cache_dir)
+    if level is None and not days:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        return
+    levels = [level] if level else _subdirs(cache_dir)
+    for lvl in levels:
+        sop_classes = [sop_class] if sop_class else _subdirs(os.path.join(cache_dir, lvl))
+        for sop in sop_classes:
+            if not days:
+                shutil.rmtree(os.path.join(cache_dir, lvl, sop), ignore_errors=True)
+                continue
+            for day in days:
+                try:
+                    os.remove(_day_path(cache_dir, lvl, sop, day))
+                except FileNotFoundError:
+                    pass
+
+
+def _subdirs(path):
+    """ Names of the subdirectories of path (empty if path does not exist) """
+    try:
+        return [entry.name for entry in os.scandir(path) if entry.is_dir()]
+    except FileNotFoundError:
+        return []
+
+
+def invalidate_days(days=None):
+    """ Manual invalidation of the given days (or the whole cache) """
+    invalidate(days=days)
+    if days:
+        print(f"Invalidated cached C-FIND results for {', '.join(days)}")
+    else:
+        print("Invalidated all cached C-FIND results")
+
+
+if __name__ == '__main__':
+    # Manual invalidation: python3 cfind_cache.py [YYYYMMDD ...]
+    invalidate_days(sys.argv[1:])
@@ -2,6 +2,7 @@ import os
 import shutil
 import pydicom
 import sys
+from dicom_scan import scan_dicom
 
 
 def copy_latest_dicom(source_folder, destination_folder, laterality):
@@ -16,8 +17,8 @@ def copy_latest_dicom(source_folder, destination_folder, laterality):
     dicom_files = []
 
     # Read all DICOM files, filter by Laterality, and sort by StudyDate
-    for file_name in os.listdir(source_folder):
-        file_path = os.path.join(source_folder, file_name)
+    for file_path in scan_dicom(source_folder, recursive=False):
+        file_name = os.path.basename(file_path)
         try:
             dicom_data = pydicom.dcmread(file_path)
             if dicom_data.get('ImageLaterality', '').upper() == laterality.upper():
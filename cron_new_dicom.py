@@ -6,11 +6,20 @@ from psycopg2 import sql
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 import subprocess
+import argparse
 from utils import load_env
+import cfind_cache
 
 
-def cfind(start_date, end_date):
-    """ Retrieve DICOM metadata from PACS using c-find for a specified date range """
+MG_SOP_CLASS_UID = '1.2.840.10008.5.1.4.1.1.1.2'  # DigitalMammographyXRayImageStorageForPresentation
+CMOVE_BATCH_SIZE = 100  # SOP Instance UIDs per c-move request (use 1 for PACS that do not accept UID lists)
+
+
+def cfind(start_date, end_date, query_level='IMAGE', sop_class=MG_SOP_CLASS_UID):
+    """ Retrieve DICOM metadata from PACS using c-find for a specified date range.
+        Returns one row per image: (patient name, patient ID, study date, study, series and SOP instance UID).
+        Returns None if the query did not complete, so that partial results are never mistaken for complete ones
+    """
     # Initialize the Application Entity
     ae = AE()
 
@@ -22,8 +31,11 @@ def cfind(start_date, end_date):
     ds.PatientName = '*'
     ds.PatientID = '*'
     ds.StudyDate = f"{start_date}-{end_date}"
-    ds.SOPClassUID = '1.2.840.10008.5.1.4.1.1.1.2'  # DigitalMammographyXRayImageStorageForPresentation
-    ds.QueryRetrieveLevel = 'IMAGE'  # Could be STUDY, SERIES, or IMAGE
+    ds.SOPClassUID = sop_class
+    ds.StudyInstanceUID = ''
+    ds.SeriesInstanceUID = ''
+    ds.SOPInstanceUID = ''
+    ds.QueryRetrieveLevel = query_level  # Could be STUDY, SERIES, or IMAGE
 
     # Retrieve PACS information from environment variables (IP, port, and AE title of the remote PACS server)
     pacs_ip = load_env('PACS_IP')
@@ -33,40 +45,76 @@ def cfind(start_date, end_date):
     # Send the C-FIND request
     assoc = ae.associate(pacs_ip, pacs_port, ae_title=pacs_ae_title)
     images_info = []
+    completed = False
 
     if assoc.is_established:
         responses = assoc.send_c_find(ds, StudyRootQueryRetrieveInformationModelFind)
         for (status, identifier) in responses:
             if status and status.Status in (0xFF00, 0xFF01):  # Pending responses
                 row = (
-                    identifier.get('PatientName', ''),
-                    identifier.get('PatientID', ''),
-                    identifier.get('StudyDate', '')
+                    str(identifier.get('PatientName', '')),
+                    str(identifier.get('PatientID', '')),
+                    str(identifier.get('StudyDate', '')),
+                    str(identifier.get('StudyInstanceUID', '')),
+                    str(identifier.get('SeriesInstanceUID', '')),
+                    str(identifier.get('SOPInstanceUID', ''))
                 )
                 images_info.append(row)
+            elif status and status.Status == 0x0000:  # Success, all matches were returned
+                completed = True
 
         assoc.release()
     else:
         print('Association rejected, aborted or never connected')
 
-    # Count occurrences and keep unique
-    row_count = {}
-    for row in images_info:
-        if row in row_count:
-            row_count[row] += 1
+    if not completed:
+        print(f'C-FIND for {start_date}-{end_date} did not complete')
+        return None
+
+    return images_info
+
+
+def cfind_cached(start_date, end_date, query_level='IMAGE', sop_class=MG_SOP_CLASS_UID,
+                 settle_days=cfind_cache.DEFAULT_SETTLE_DAYS, ttl_hours=cfind_cache.DEFAULT_TTL_HOURS):
+    """ Same as cfind, but only days that are not settled (or whose cached results expired) are queried from PACS.
+        Contiguous stale days are fetched with a single c-find and the results are cached per day
+    """
+    days = cfind_cache.days_between(start_date, end_date)
+    stale = cfind_cache.stale_days(query_level, sop_class, days, settle_days, ttl_hours)
+    print(f"Days queried from PACS: {stale if stale else 'none (all cached)'}")
+
+    fetched = {}
+    for range_start, range_end in cfind_cache.day_ranges(stale):
+        results = cfind(range_start, range_end, query_level, sop_class)
+        if results is None:
+            continue  # Leave these days uncached, they will be queried again on the next run
+        for day in cfind_cache.days_between(range_start, range_end):
+            fetched[day] = []
+        for row in results:
+            fetched.setdefault(row[2], []).append(row)
+        for day, rows in fetched.items():
+            if range_start <= day <= range_end:
+                cfind_cache.save_day(query_level, sop_class, day, rows)
+
+    unique_images_info = []
+    for day in days:
+        if day in fetched:
+            unique_images_info.extend(fetched[day])
         else:
-            row_count[row] = 1
-    # Convert to list including counts
-    unique_images_info = [[*row, count] for row, count in row_count.items()]
-
+            entry = cfind_cache.load_day(query_level, sop_class, day)
+            if entry is not None:
+                unique_images_info.extend(entry['rows'])
     return unique_images_info
 
 
 def read_postgres(table_name, start_date, end_date):
-    """ Retrieve DICOM metadata from a postgres database table for a specified date range """
+    """ Retrieve DICOM metadata from a postgres database table for a specified date range.
+        Returns None if the table could not be read (e.g. the sop_instance_uid column is missing), so that the caller
+        does not mistake a failed read for an empty table
+    """
     conn = None
     cursor = None
-    records = []
+    records = None
 
     # Retrieve database information from environment variables (name, user, pass, host, port)
     db_name = load_env('DB_NAME')
@@ -91,10 +139,9 @@ def read_postgres(table_name, start_date, end_date):
 
         # Define the select statement to filter by date range
         select_query = sql.SQL("""
-                    SELECT patient_name, patient_id, acquisition_date, COUNT(*)
+                    SELECT patient_name, patient_id, acquisition_date, sop_instance_uid
                     FROM {table}
                     WHERE acquisition_date BETWEEN %s AND %s
-                    GROUP BY patient_name, patient_id, acquisition_date
                     ORDER BY acquisition_date, patient_name
                 """).format(table=sql.Identifier(table_name))
 
@@ -105,7 +152,7 @@ def read_postgres(table_name, start_date, end_date):
         records = cursor.fetchall()
 
     except Exception as e:
-        print(f"Error: {e}")
+        print(f"Error reading {table_name}: {e}")
     finally:
         # Close the database connection
         if cursor:
@@ -117,46 +164,81 @@ def read_postgres(table_name, start_date, end_date):
 
 
 def compare_results(cfind_results, postgres_results):
-    """ Compare results from PACS and postgres and return whatever exists in PACS but not in postgres """
+    """ Compare results from PACS and postgres and return the images (c-find rows) that are in PACS but not in postgres.
+        Images are matched by SOP Instance UID. Rows stored before the UID was recorded can only be counted, so a
+        (patient name, patient ID, date) group is considered complete if they make up for the unmatched images
+    """
     # Ensure that all data types are consistent (e.g., converting all to strings for direct comparison)
-    cfind_set = set(tuple(str(x) for x in row) for row in cfind_results)
-    postgres_set = set(tuple(str(x) for x in row) for row in postgres_results)
-
-    # Find elements in cfind set not in postgres set
-    unique_to_cfind = cfind_set - postgres_set
+    stored_uids = set()
+    legacy_counts = {}
+    for patient_name, patient_id, acquisition_date, sop_instance_uid in postgres_results:
+        uid = str(sop_instance_uid).strip() if sop_instance_uid is not None else ''
+        if uid:
+            stored_uids.add(uid)
+        else:
+            key = (str(patient_name), str(patient_id), str(acquisition_date))
+            legacy_counts[key] = legacy_counts.get(key, 0) + 1
+
+    # Find images in cfind results not in postgres, grouped by patient and date
+    missing = {}
+    for row in cfind_results:
+        if row[5] not in stored_uids:
+            missing.setdefault(tuple(str(x) for x in row[:3]), []).append(tuple(row))
+
+    unique_to_cfind = []
+    for key, rows in missing.items():
+        if legacy_counts.get(key, 0) < len(rows):
+            unique_to_cfind.extend(rows)
     return unique_to_cfind
 
 
-def cmove(entries):
-    """ Download DICOM images """
+def cmove(entries, batch_size=CMOVE_BATCH_SIZE):
+    """ Download the given DICOM images (c-find rows). Images of the same series are requested together,
+        batch_size SOP Instance UIDs per c-move, so filling a gap never re-transfers the whole study
+    """
 
     # Retrieve PACS information from environment variables (IP, port, and AE title of the remote PACS server)
     pacs_ip = load_env('PACS_IP')
     pacs_port = load_env('PACS_PORT')
     pacs_ae_title = load_env('PACS_AE_TITLE')
 
-    for entry in unique_entries:
-        patient_name, patient_id, study_date, num_images = entry
-        command = [
-            'movescu', '-aet', 'PYNETDICOM', '-aec', pacs_ae_title, pacs_ip, pacs_port,
-            '-k', '0008,0052=IMAGE',
-            '-k', '0008,0016=1.2.840.10008.5.1.4.1.1.1.2',  # SOP Class UID for Digital Mammography X-Ray
-            '-k', f'0008,0020={study_date}',
-            '-k', f'0010,0020={patient_id}',
-            '-d'
-        ]
-        try:
-            result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-            print(f'Success running movescu for {patient_id}, {study_date}: {result.stdout.decode()}')
-        except subprocess.CalledProcessError as e:
-            print(f'Error running movescu for {patient_id}, {study_date}: {e.stderr.decode()}')
+    # Group the missing images by series (IMAGE level c-move needs a single study and series UID)
+    series = {}
+    for patient_name, patient_id, study_date, study_uid, series_uid, sop_uid in entries:
+        series.setdefault((patient_id, study_date, study_uid, series_uid), []).append(sop_uid)
+
+    for (patient_id, study_date, study_uid, series_uid), sop_uids in series.items():
+        for i in range(0, len(sop_uids), batch_size):
+            batch = sop_uids[i:i + batch_size]
+            command = [
+                'movescu', '-aet', 'PYNETDICOM', '-aec', pacs_ae_title, pacs_ip, pacs_port,
+                '-k', '0008,0052=IMAGE',
+                '-k', f'0010,0020={patient_id}',  # unique key of the patient root model movescu uses by default
+                '-k', f'0020,000D={study_uid}',
+                '-k', f'0020,000E={series_uid}',
+                '-k', '0008,0018=' + '\\'.join(batch),  # list of SOP Instance UIDs
+                '-d'
+            ]
+            try:
+                result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+                print(f'Success running movescu for {patient_id}, {study_date} ({len(batch)} images): '
+                      f'{result.stdout.decode()}')
+            except subprocess.CalledProcessError as e:
+                print(f'Error running movescu for {patient_id}, {study_date} ({len(batch)} images): '
+                      f'{e.stderr.decode()}')
+
+
+def sync(table_name='dicom_metadata', days=6, use_cache=True, settle_days=cfind_cache.DEFAULT_SETTLE_DAYS,
+         ttl_hours=cfind_cache.DEFAULT_TTL_HOURS, invalidate=None, batch_size=CMOVE_BATCH_SIZE):
+    """ Download every image found in PACS over the last days that is missing from the postgres table.
+        invalidate is a list of days (empty list = all days) whose cached c-find results are dropped first
+    """
+    if invalidate is not None:
+        cfind_cache.invalidate(days=invalidate)
 
-if __name__ == '__main__':
-    # Name of postgres table for dicom metadata
-    table_name = 'dicom_metadata'
     # Start and end date
     end_date = datetime.now()  # Current date
-    start_date = end_date - relativedelta(days=6)  # How far back we want to go for data extraction (days, months, years)
+    start_date = end_date - relativedelta(days=days)  # How far back we want to go for data extraction
 
     # Format dates for the queries
     formatted_end_date = end_date.strftime('%Y%m%d')
@@ -164,23 +246,45 @@ if __name__ == '__main__':
     print(f"Start date: {formatted_start_date}")
     print(f"End date: {formatted_end_date}")
 
-    # C-find dicom images in pacs
-    cfind_data = cfind(formatted_start_date, formatted_end_date)
-    print(f"\nThe following data was extracted using c-find:\n{cfind_data}")
+    # C-find dicom images in pacs (days that settled earlier are served from the local cache)
+    if use_cache:
+        cfind_data = cfind_cached(formatted_start_date, formatted_end_date, settle_days=settle_days,
+                                  ttl_hours=ttl_hours)
+    else:
+        cfind_data = cfind(formatted_start_date, formatted_end_date) or []
+    print(f"\n{len(cfind_data)} images were found using c-find")
 
     # Existing dicom images in postgres
     postgres_data = read_postgres(table_name, formatted_start_date, formatted_end_date)
-    print(f"\nThe following data was extracted from postgres:\n{postgres_data}")
+    if postgres_data is None:
+        # Every PACS image would look missing and the whole window would be moved again
+        print("Could not read postgres, aborting without c-move.")
+        return
+    print(f"\n{len(postgres_data)} images were found in postgres")
 
     # Check what is missing in postgres
     unique_entries = compare_results(cfind_data, postgres_data)
-    print(f"\nThe following is the difference between c-find and postgres:\n{unique_entries}")
-
-    cmove(unique_entries)
-
-
-
+    print("\nThe following images are in PACS but not in postgres:")
+    for patient_name, patient_id, study_date, study_uid, series_uid, sop_uid in unique_entries:
+        print(f"{patient_name}, {patient_id}, {study_date}: {sop_uid}")
 
+    cmove(unique_entries, batch_size)
 
 
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Download images that are in PACS but missing from postgres.')
+    arg_parser.add_argument('--days', type=int, default=6, help='How many days back to look (default 6)')
+    arg_parser.add_argument('--settle-days', type=int, default=cfind_cache.DEFAULT_SETTLE_DAYS,
+                            help='Days after which cached c-find results for a day are never refreshed')
+    arg_parser.add_argument('--ttl-hours', type=float, default=cfind_cache.DEFAULT_TTL_HOURS,
+                            help='How long cached c-find results for recent days are reused')
+    arg_parser.add_argument('--no-cache', action='store_true', help='Query the whole window from PACS')
+    arg_parser.add_argument('--batch-size', type=int, default=CMOVE_BATCH_SIZE,
+                            help='SOP Instance UIDs per c-move request (default %(default)s)')
+    arg_parser.add_argument('--invalidate', nargs='*', metavar='YYYYMMDD',
+                            help='Drop cached c-find results for the given days (all days if none given) first')
+    args = arg_parser.parse_args()
 
+    # Name of postgres table for dicom metadata
+    sync('dicom_metadata', args.days, not args.no_cache, args.settle_days, args.ttl_hours, args.invalidate,
+         args.batch_size)
@@ -3,6 +3,8 @@ import sys
 import zlib
 from cryptography.fernet import Fernet
 import pydicom
+from dicom_scan import scan_dicom
+from pseudonym import PSEUDONYM_TAG, POSTGRES_INDEX, index_location, open_index, remove_from_index
 
 
 def decrypt_decompress_data(data, key):
@@ -13,29 +15,43 @@ def decrypt_decompress_data(data, key):
     return decrypted_data.decode()
 
 
-def decrypt(folder_path):
-    """Decrypt PatientName and PatientID in all dicom files in folder_path."""
+def decrypt(folder_path, index_path=None):
+    """Decrypt PatientName and PatientID in all dicom files in folder_path.
+    Decrypted files no longer carry a patient pseudonym and are removed from the pseudonym index."""
     key = os.getenv('AES_KEY')  # load AES key
     if not key:
         raise EnvironmentError("AES_KEY environment variable not set.")
 
-    for entry in os.listdir(folder_path):
-        dicom_path = os.path.join(folder_path, entry)
-        if os.path.isfile(dicom_path):
+    index_path = index_location(index_path)
+    index = open_index(index_path) if index_path == POSTGRES_INDEX or os.path.exists(index_path) else None
+    try:
+        for dicom_path in scan_dicom(folder_path, recursive=False):
             try:
                 ds = pydicom.dcmread(dicom_path)
+                # The encrypted values are removed, so the decrypted file is encrypted again by a later encrypt run
                 if (0x1001, 0x0010) in ds:
                     ds.PatientName = decrypt_decompress_data(ds[0x1001, 0x0010].value, key)     # patient name
+                    del ds[0x1001, 0x0010]
                 if (0x1001, 0x0020) in ds:
                     ds.PatientID = decrypt_decompress_data(ds[0x1001, 0x0020].value, key)       # patient ID
+                    del ds[0x1001, 0x0020]
+                if PSEUDONYM_TAG in ds:
+                    del ds[PSEUDONYM_TAG]                                                       # patient pseudonym
                 ds.save_as(dicom_path)
+                if index is not None:
+                    remove_from_index(index, dicom_path)
+                    index.commit()
                 print(f"Decrypted {dicom_path}")
             except Exception as e:
                 print(f"Failed to process {dicom_path}: {str(e)}")
+    finally:
+        if index is not None:
+            index.commit()
+            index.close()
 
 
 if __name__ == '__main__':
     if len(sys.argv) > 1:
-        decrypt(sys.argv[1])
+        decrypt(*sys.argv[1:3])
     else:
         print("Please provide dicom folder.")
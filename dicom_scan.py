@@ -0,0 +1,100 @@
+import os
+import sys
+from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+DICOM_PREAMBLE_LEN = 128
+DICOM_MAGIC = b'DICM'
+# DICOMDIR carries a valid preamble too, so it has to be excluded by name
+DEFAULT_EXCLUDE = ['DICOMDIR']
+
+
+def is_dicom(file_path):
+    """ Check the 128-byte preamble followed by the 'DICM' marker without parsing the file """
+    try:
+        with open(file_path, 'rb') as f:
+            header = f.read(DICOM_PREAMBLE_LEN + len(DICOM_MAGIC))
+    except OSError:
+        return False
+    return header[DICOM_PREAMBLE_LEN:] == DICOM_MAGIC
+
+
+def _matches(rel_path, name, patterns):
+    """ True if the file name or its path relative to the scan root matches any of the glob patterns """
+    return any(fnmatch(name, pattern) or fnmatch(rel_path, pattern) for pattern in patterns)
+
+
+def _scan_dir(root, dir_path, include, exclude, recursive, check_magic):
+    """ Scan a single directory and return (dicom file paths, subdirectories to descend into) """
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                rel_path = os.path.relpath(entry.path, root)
+                if exclude and _matches(rel_path, entry.name, exclude):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            subdirs.append(entry.path)
+                        continue
+                    if not entry.is_file():
+                        continue
+                except OSError:
+                    continue
+                if include and not _matches(rel_path, entry.name, include):
+                    continue
+                if check_magic and not is_dicom(entry.path):
+                    continue
+                files.append(entry.path)
+    except OSError as e:
+        print(f"Failed to scan {dir_path}: {e}")
+    return files, subdirs
+
+
+def scan_dicom(root, include=None, exclude=None, recursive=True, check_magic=True, workers=8):
+    """ Lazily yield paths of DICOM files under root.
+
+    Subdirectories are scanned in parallel with os.scandir, and non-DICOM files (logs, reports, ...) are rejected
+    by their magic bytes instead of a failed dcmread.
+
+    Parameters:
+    - root: The directory to scan.
+    - include: Glob patterns a file name (or path relative to root) must match, e.g. ['*.dcm']. None accepts all.
+    - exclude: Glob patterns for files and directories to skip, e.g. ['*.txt']. Always added to DEFAULT_EXCLUDE,
+      since DICOMDIR passes the magic-byte check.
+    - recursive: Descend into subdirectories.
+    - check_magic: Reject files without the DICOM preamble and 'DICM' marker.
+    - workers: Number of directories scanned concurrently.
+    """
+    include = list(include or [])
+    exclude = DEFAULT_EXCLUDE + list(exclude or [])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(_scan_dir, root, root, include, exclude, recursive, check_magic)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                for subdir in subdirs:
+                    pending.add(executor.submit(_scan_dir, root, subdir, include, exclude, recursive, check_magic))
+                for file_path in files:
+                    yield file_path
+
+
+def list_dicom(root):
+    """ Print every DICOM file under root """
+    count = 0
+    for path in scan_dicom(root):
+        print(path)
+        count += 1
+    print(f"Found {count} DICOM files.")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        list_dicom(sys.argv[1])
+    else:
+        print("Please provide dicom folder.")
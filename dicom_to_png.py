@@ -1,4 +1,5 @@
 import os
+import tempfile
 import sys
 import pydicom
 import numpy as np
@@ -9,6 +10,8 @@ import re
 import psycopg2
 from psycopg2 import sql
 from utils import load_env
+from dicom_scan import scan_dicom
+from breast_crop import breast_bbox, crop_and_normalize, format_crop_box
 
 
 def get_attr(dicom, attr, default=' '):
@@ -21,10 +24,14 @@ def get_attr(dicom, attr, default=' '):
 
 # Function to insert data into dicom_metadata table
 def insert_dicom_metadata(table_name, mammography_id, patient_name, patient_id, acquisition_date, acquisition_time,
-                          view, laterality, implant, manufacturer, manufacturer_model, institution):
-    """ Extract dicom metadata and store to postgres database table """
+                          view, laterality, implant, manufacturer, manufacturer_model, institution, sop_instance_uid,
+                          crop_box=None):
+    """ Extract dicom metadata and store to postgres database table.
+        Returns True if the row was inserted, False if mammography_id was already in the table
+    """
     conn = None
     cursor = None
+    inserted = False
 
     # Retrieve database information from environment variables (name, user, pass, host, port)
     db_name = load_env('DB_NAME')
@@ -55,24 +62,30 @@ def insert_dicom_metadata(table_name, mammography_id, patient_name, patient_id,
         if exists:
             print(f"mammography_id {mammography_id} already exists in the table {table_name}. No data inserted.")
         else:
+            columns = ['mammography_id', 'patient_name', 'patient_id', 'acquisition_date', 'acquisition_time', 'view',
+                       'laterality', 'implant', 'manufacturer', 'manufacturer_model', 'institution', 'sop_instance_uid']
+            values = [mammography_id, patient_name, patient_id, acquisition_date, acquisition_time, view, laterality,
+                      implant, manufacturer, manufacturer_model, institution, sop_instance_uid]
+            # crop_box is only written for cropped images, so tables without the column keep working without --crop
+            if crop_box is not None:
+                columns.append('crop_box')
+                values.append(crop_box)
+
             # Define the insert statement
-            insert_query = sql.SQL("""
-                INSERT INTO {table} (mammography_id, patient_name, patient_id, acquisition_date, acquisition_time,
-                          view, laterality, implant, manufacturer, manufacturer_model, institution)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """).format(table=sql.Identifier(table_name))
+            insert_query = sql.SQL("INSERT INTO {table} ({columns}) VALUES ({values})").format(
+                table=sql.Identifier(table_name),
+                columns=sql.SQL(', ').join(sql.Identifier(column) for column in columns),
+                values=sql.SQL(', ').join(sql.Placeholder() for _ in values))
 
             # Execute the insert statement
-            cursor.execute(insert_query, (mammography_id, patient_name, patient_id, acquisition_date, acquisition_time,
-                                          view, laterality, implant, manufacturer, manufacturer_model, institution))
+            cursor.execute(insert_query, values)
 
             # Commit the transaction
             conn.commit()
 
             print(f"Data for mammography_id {mammography_id} successfully inserted into {table_name}.")
+            inserted = True
 
-    except Exception as e:
-        print(f"Error: {e}")
     finally:
         # Close the database connection
         if cursor:
@@ -80,82 +93,132 @@ def insert_dicom_metadata(table_name, mammography_id, patient_name, patient_id,
         if conn:
             conn.close()
 
+    return inserted
 
-def png_to_minio(dicom_folder):
-    """ Load dicom image, convert to .png format and store in minio server (if it is not already there)
-        Once the image is processed, add corresponding metadata to the sql table (using insert_dicom_metadata function)
-    :param dicom_folder: path to dicom folder
-    """
 
+def minio_client():
+    """ Create a minio client from the MINIO_* environment variables """
     minio_host = load_env('MINIO_HOST')
     minio_acc_key = load_env('MINIO_ACC_KEY')
     minio_secret_key = load_env('MINIO_SECRET_KEY')
+    return Minio(minio_host,
+                 access_key=minio_acc_key,
+                 secret_key=minio_secret_key,
+                 secure=False
+                 )
 
-    for filename in os.listdir(dicom_folder):
-        dicom_path = os.path.join(dicom_folder, filename)
-        dicom_image = pydicom.dcmread(dicom_path)
-        # Get the pixel array from the DICOM file
-        pixel_array = dicom_image.pixel_array
-        # Normalize the pixel values to be in the range 0-255 (for 8-bit greyscale)
-        pixel_array = ((pixel_array - np.min(pixel_array)) / (np.max(pixel_array) - np.min(pixel_array))) * 255.0
-        pixel_array = pixel_array.astype(np.uint8)
-        # Define path for .png image
-        png_image = os.path.basename(dicom_path)
-        png_image = re.sub(r'\.(dcm|dicom)$', '', png_image)
-        png_image = png_image + '.png'  # image name
-        png_filepath = os.path.join(os.getcwd(), png_image)  # image path
-        # Save .png image locally
-        cv2.imwrite(png_filepath, pixel_array)
 
-        # Save to minio
-        client = Minio(minio_host,
-                       access_key=minio_acc_key,
-                       secret_key=minio_secret_key,
-                       secure=False
-                       )
+def png_array(dicom_image, crop=False):
+    """ 8-bit greyscale pixel array for the .png image, and the crop box ('x,y,width,height,rows,columns') or None.
+        With crop, the image is cropped to the breast and normalized using the tissue intensities only
+    """
+    # Get the pixel array from the DICOM file
+    pixel_array = dicom_image.pixel_array
+    if crop:
+        box, mask = breast_bbox(pixel_array, getattr(dicom_image, 'ImageLaterality', None),
+                                getattr(dicom_image, 'PhotometricInterpretation', '') == 'MONOCHROME1')
+        if box is not None:
+            rows, columns = pixel_array.shape[:2]
+            return crop_and_normalize(pixel_array, box, mask), format_crop_box(box, rows, columns)
+    # Normalize the pixel values to be in the range 0-255 (for 8-bit greyscale)
+    pixel_array = ((pixel_array - np.min(pixel_array)) / (np.max(pixel_array) - np.min(pixel_array))) * 255.0
+    return pixel_array.astype(np.uint8), None
+
+
+def dicom_to_minio(dicom_path, client, crop=False):
+    """ Convert a single dicom image to .png, store it in minio (if it is not already there) and add its metadata
+        to the sql table. Raises if the image could not be read or uploaded, so that the caller can retry it.
+        Returns the metadata row (column name: value) if it was inserted, e.g. for the metadata lake, otherwise None
+    :param dicom_path: path to dicom file
+    :param client: minio client
+    :param crop: crop the image to the breast before encoding (the crop box is stored with the metadata)
+    """
+    dicom_image = pydicom.dcmread(dicom_path)
+    pixel_array, crop_box = png_array(dicom_image, crop)
+    # Define path for .png image
+    png_image = os.path.basename(dicom_path)
+    png_image = re.sub(r'\.(dcm|dicom)$', '', png_image)
+    png_image = png_image + '.png'  # image name
+    # Save .png image locally, in a temporary file of its own: concurrent workers may convert files with the same name
+    fd, png_filepath = tempfile.mkstemp(suffix='.png')
+    os.close(fd)
+
+    # Save to minio
+    try:
+        cv2.imwrite(png_filepath, pixel_array)
         try:  # Check if .png file has already been uploaded
             # Try to get the object's metadata
-            client.stat_object("firstbucket", png_image)
+            stored = client.stat_object("firstbucket", png_image)
             print(f"Object '{png_image}' already exists in firstbucket. Skipping upload.")
+            # The stored object may come from a run with a different --crop; record its crop box, not this one
+            crop_box = (stored.metadata or {}).get('x-amz-meta-crop-box')
         except S3Error as e:
             # If the object does not exist, an exception is thrown
-            if e.code == 'NoSuchKey':
-                # Object does not exist, proceed with upload
-                try:
-                    result = client.fput_object("firstbucket", png_image, png_filepath)
-                    print(f"Uploaded object {png_image}, etag: {result.etag}")
-                except S3Error as err:
-                    print(f"Failed to upload object {png_image} due to: {err}")
-            else:
-                # Other S3 errors
-                print(f"Error occurred: {e}")
-
+            if e.code != 'NoSuchKey':
+                raise  # Other S3 errors
+            # Object does not exist, proceed with upload
+            metadata = {'crop-box': crop_box} if crop_box else None
+            result = client.fput_object("firstbucket", png_image, png_filepath, metadata=metadata)
+            print(f"Uploaded object {png_image}, etag: {result.etag}")
+    finally:
         # Remove the locally saved .png image
         os.remove(png_filepath)
 
-        # Add metadata info to table. Not all dicom have all the data (default = ' ')
-
-        dcm_study_id = re.sub(r'\.(dcm|dicom)$', '', os.path.basename(dicom_path))
-        # Name of postgres table for dicom metadata
-        table_name = 'dicom_metadata'
-        insert_dicom_metadata(
-            table_name,
-            dcm_study_id,
-            get_attr(dicom_image, 'PatientName'),
-            get_attr(dicom_image, 'PatientID'),
-            get_attr(dicom_image, 'AcquisitionDate'),
-            get_attr(dicom_image, 'AcquisitionTime'),
-            get_attr(dicom_image, 'ViewPosition'),  # Could be missing
-            get_attr(dicom_image, 'ImageLaterality'),  # Could be missing
-            get_attr(dicom_image, 'BreastImplantPresent'),  # Custom default value
-            get_attr(dicom_image, 'Manufacturer'),
-            get_attr(dicom_image, 'ManufacturerModelName'),
-            get_attr(dicom_image, 'InstitutionName')
-        )
+    # Add metadata info to table. Not all dicom have all the data (default = ' ')
+
+    dcm_study_id = re.sub(r'\.(dcm|dicom)$', '', os.path.basename(dicom_path))
+    metadata = {
+        'mammography_id': dcm_study_id,
+        'patient_name': get_attr(dicom_image, 'PatientName'),
+        'patient_id': get_attr(dicom_image, 'PatientID'),
+        'acquisition_date': get_attr(dicom_image, 'AcquisitionDate'),
+        'acquisition_time': get_attr(dicom_image, 'AcquisitionTime'),
+        'view': get_attr(dicom_image, 'ViewPosition'),  # Could be missing
+        'laterality': get_attr(dicom_image, 'ImageLaterality'),  # Could be missing
+        'implant': get_attr(dicom_image, 'BreastImplantPresent'),  # Custom default value
+        'manufacturer': get_attr(dicom_image, 'Manufacturer'),
+        'manufacturer_model': get_attr(dicom_image, 'ManufacturerModelName'),
+        'institution': get_attr(dicom_image, 'InstitutionName'),
+        'sop_instance_uid': get_attr(dicom_image, 'SOPInstanceUID'),  # Used by cron_new_dicom to find missing images
+        'crop_box': crop_box  # Crop box of the object in minio, None if it is not cropped
+    }
+    # Name of postgres table for dicom metadata
+    table_name = 'dicom_metadata'
+    if insert_dicom_metadata(table_name, **metadata):
+        return metadata
+    return None
+
+
+def png_to_minio(dicom_folder, crop=False):
+    """ Load dicom image, convert to .png format and store in minio server (if it is not already there)
+        Once the image is processed, add corresponding metadata to the sql table (using insert_dicom_metadata function)
+    :param dicom_folder: path to dicom folder
+    :param crop: crop the images to the breast before encoding
+    """
+    client = minio_client()
+    # Newly inserted metadata rows are also appended to the Parquet metadata lake in batches. metadata_lake (and
+    # pyarrow) is only imported if METADATA_LAKE is set
+    lake = None
+    if os.getenv('METADATA_LAKE'):
+        import metadata_lake as lake
+    lake_rows = []
+
+    for dicom_path in scan_dicom(dicom_folder, recursive=False):
+        try:
+            row = dicom_to_minio(dicom_path, client, crop)
+            if lake is not None and row is not None:
+                lake_rows.append(row)
+        except Exception as e:
+            print(f"Failed to process {dicom_path}: {e}")
+        if lake is not None and len(lake_rows) >= lake.LAKE_BATCH_SIZE:
+            lake.try_write_batch(lake_rows)
+            lake_rows = []
+    if lake is not None:
+        lake.try_write_batch(lake_rows)
 
 
 if __name__ == '__main__':
     if len(sys.argv) > 1:
-        png_to_minio(sys.argv[1])
+        png_to_minio(sys.argv[1], '--crop' in sys.argv[2:])
     else:
         print("Please provide dicom folder path.")
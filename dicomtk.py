@@ -0,0 +1,294 @@
+import os
+import sys
+import json
+import socket
+import signal
+import argparse
+import importlib
+import subprocess
+
+
+# Subcommands only import their own module when they run, so e.g. `dicomtk encrypt` never loads cv2 or pandas.
+# name: (module, function, help, [(argument, options), ...])
+COMMANDS = {
+    'png': ('dicom_to_png', 'png_to_minio', 'Convert DICOM files to .png, upload them to minio and store metadata', [
+        ('dicom_folder', {}),
+        ('--crop', {'action': 'store_true', 'default': None, 'help': 'Crop images to the breast before encoding'}),
+    ]),
+    'encrypt': ('encrypt', 'encrypt', 'Encrypt PatientName and PatientID and write patient pseudonyms', [
+        ('folder_path', {}),
+        ('--index-path', {'help': "Pseudonym index (default pseudonym_index.sqlite, 'postgres' for the shared table)"}),
+    ]),
+    'decrypt': ('decrypt', 'decrypt', 'Decrypt PatientName and PatientID', [
+        ('folder_path', {}),
+        ('--index-path', {'help': "Pseudonym index (default pseudonym_index.sqlite, 'postgres' for the shared table)"}),
+    ]),
+    'pseudonym': ('pseudonym', 'find_patient', 'Find all encrypted files of a patient via the pseudonym index', [
+        ('patient_id', {}),
+        ('--index-path', {'help': "Pseudonym index (default pseudonym_index.sqlite, 'postgres' for the shared table)"}),
+    ]),
+    'scan': ('dicom_scan', 'list_dicom', 'List all DICOM files in a directory tree', [
+        ('root', {}),
+    ]),
+    'cp-latest': ('cp_latest', 'copy_latest_dicom', 'Copy the latest DICOM images of one laterality', [
+        ('source_folder', {}),
+        ('destination_folder', {}),
+        ('laterality', {'type': str.upper, 'choices': ['L', 'R']}),
+    ]),
+    'download-today': ('cron_daily_movescu', 'dwnld', 'Download DICOM images for the current date', []),
+    'download-dates': ('movescu_dates', 'dwnld', 'Download DICOM MG images for a date range', [
+        ('initial_date', {'help': 'YYYYMMDD'}),
+        ('end_date', {'help': 'YYYYMMDD'}),
+    ]),
+    'download-table': ('movescu_table', 'process_table', 'Download DICOM MG images for patients in an Excel table', [
+        ('excel_path', {}),
+    ]),
+    'sync': ('cron_new_dicom', 'sync', 'Download images that are in PACS but missing from postgres', [
+        ('--table-name', {'default': 'dicom_metadata'}),
+        ('--days', {'type': int, 'help': 'How many days back to look (default 6)'}),
+        ('--no-cache', {'dest': 'use_cache', 'action': 'store_false', 'default': None,
+                        'help': 'Query the whole window from PACS'}),
+        ('--settle-days', {'type': int, 'help': 'Days after which cached c-find results are never refreshed'}),
+        ('--ttl-hours', {'type': float, 'help': 'How long cached c-find results for recent days are reused'}),
+        ('--invalidate', {'nargs': '*', 'metavar': 'YYYYMMDD', 'help': 'Drop cached c-find results first'}),
+        ('--batch-size', {'type': int, 'help': 'SOP Instance UIDs per c-move request (default 100)'}),
+    ]),
+    'cache-invalidate': ('cfind_cache', 'invalidate_days', 'Invalidate cached c-find results', [
+        ('days', {'nargs': '*', 'metavar': 'YYYYMMDD', 'help': 'Days to invalidate (all if none given)'}),
+    ]),
+    'findscu': ('findscu', 'find', 'Query PACS for mammography series in a date range', [
+        ('start_date', {'nargs': '?', 'help': 'YYYYMMDD'}),
+        ('end_date', {'nargs': '?', 'help': 'YYYYMMDD'}),
+    ]),
+    'extract': ('extract_dicom_data', 'main', 'Write DICOM metadata annotated with BIRADS data to a CSV file', [
+        ('birads_xls', {}),
+        ('directory_path', {}),
+        ('output_csv', {}),
+    ]),
+    'report': ('generate_report', 'main', 'Match DICOM files with the closest BIRADS screening', [
+        ('info_path', {}),
+        ('dicom_directory', {}),
+        ('output_path', {}),
+    ]),
+    'lake-report': ('generate_report', 'lake_report', 'Match metadata lake records with the closest BIRADS screening', [
+        ('info_path', {}),
+        ('output_path', {}),
+        ('--start-month', {'help': 'YYYY-MM'}),
+        ('--end-month', {'help': 'YYYY-MM'}),
+    ]),
+    'lake-counts': ('metadata_lake', 'print_counts', 'Images per month and metadata column from the metadata lake', [
+        ('by', {'nargs': '+'}),
+        ('--start-month', {'help': 'YYYY-MM'}),
+        ('--end-month', {'help': 'YYYY-MM'}),
+    ]),
+    'lake-backfill': ('metadata_lake', 'backfill', 'Export dicom_metadata rows to the metadata lake', [
+        ('--start-month', {'help': 'YYYY-MM'}),
+        ('--end-month', {'help': 'YYYY-MM'}),
+    ]),
+    'lake-compact': ('metadata_lake', 'compact', 'Merge small files of each metadata lake partition', [
+        ('--min-files', {'type': int}),
+    ]),
+    'genkey': ('generate_key', 'generate_key', 'Generate a Fernet encryption key', []),
+    'enqueue': ('job_queue', 'enqueue', 'Enqueue all DICOM files of a folder on the postgres job queue', [
+        ('queue', {'choices': ['encrypt', 'png']}),
+        ('folder', {}),
+        ('--no-recursive', {'dest': 'recursive', 'action': 'store_false', 'default': None}),
+        ('--max-attempts', {'type': int}),
+    ]),
+    'work': ('job_queue', 'run_workers', 'Process jobs of a queue (any number of hosts can run workers)', [
+        ('queue', {'choices': ['encrypt', 'png']}),
+        ('--processes', {'type': int, 'help': 'Worker processes on this host (default 1)'}),
+        ('--batch-size', {'type': int}),
+        ('--lease-seconds', {'type': int}),
+        ('--poll-seconds', {'type': float}),
+        ('--exit-when-empty', {'action': 'store_true', 'default': None}),
+        ('--crop', {'action': 'store_true', 'default': None, 'help': 'png queue: crop images to the breast'}),
+    ]),
+    'queue-progress': ('job_queue', 'print_progress', 'Show job queue progress', [
+        ('queue', {'nargs': '?'}),
+        ('--retry-failed', {'dest': 'retry', 'action': 'store_true', 'default': None}),
+    ]),
+}
+
+DEFAULT_SOCKET = os.getenv('DICOMTK_SOCKET', os.path.join(os.path.expanduser('~'), '.dicomtk.sock'))
+EXIT_MARKER = b'\0dicomtk-exit:'
+
+
+def build_parser():
+    """ Argument parser with one subcommand per tool plus the daemon and import-times commands """
+    parser = argparse.ArgumentParser(prog='dicomtk', description='DICOM toolkit.')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='Daemon socket path (default %(default)s)')
+    parser.add_argument('--no-daemon', action='store_true', help='Never hand the job to a running daemon')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    for name, (module, function, help_text, arguments) in COMMANDS.items():
+        subparser = subparsers.add_parser(name, help=help_text)
+        for argument, options in arguments:
+            subparser.add_argument(argument, **options)
+        subparser.set_defaults(target=(module, function))
+
+    daemon_parser = subparsers.add_parser('daemon',
+                                          help='Run a resident daemon with preloaded modules (saves import time only)')
+    daemon_parser.add_argument('--preload', nargs='*', choices=sorted(COMMANDS),
+                               help='Subcommands whose modules are imported up front (default all)')
+    daemon_parser.set_defaults(target=None)
+
+    times_parser = subparsers.add_parser('import-times', help='Measure the import time of each subcommand')
+    times_parser.add_argument('--repeat', type=int, default=3, help='Runs per subcommand, the best one is reported')
+    times_parser.set_defaults(target=None)
+    return parser
+
+
+def run_command(args):
+    """ Import the module of the subcommand and call its function with the parsed arguments """
+    module_name, function_name = args.target
+    kwargs = {key: value for key, value in vars(args).items()
+              if key not in ('command', 'target', 'socket', 'no_daemon') and value is not None}
+    function = getattr(importlib.import_module(module_name), function_name)
+    return function(**kwargs)
+
+
+def measure_import_times(repeat=3):
+    """ Print how long each subcommand takes to import its module, measured in a fresh interpreter """
+    code = ('import time; start = time.perf_counter(); import {module}; '
+            'print(time.perf_counter() - start)')
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    modules = sorted(set(module for module, _, _, _ in COMMANDS.values()))
+    print(f"{'module':<24}{'import time':>14}  subcommands")
+    for module in modules:
+        commands = ', '.join(name for name, spec in COMMANDS.items() if spec[0] == module)
+        timings = []
+        for _ in range(repeat):
+            result = subprocess.run([sys.executable, '-c', code.format(module=module)], cwd=cwd,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            if result.returncode != 0:
+                timings = None
+                break
+            timings.append(float(result.stdout.strip().splitlines()[-1]))
+        if timings is None:
+            print(f"{module:<24}{'failed':>14}  {commands}")
+        else:
+            print(f"{module:<24}{min(timings) * 1000:>11.1f} ms  {commands}")
+
+
+def _run_job(conn, parser):
+    """ Run a single job in a forked child of the daemon, with stdout/stderr going back over the socket """
+    code = 0
+    # Jobs run subprocess (movescu) and need their exit codes, so children must not be auto-reaped
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        request = json.loads(conn.makefile('rb').readline().decode())
+        os.dup2(conn.fileno(), 1)
+        os.dup2(conn.fileno(), 2)
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        run_command(parser.parse_args(request['argv']))
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException as e:
+        print(f"Error: {e}", file=sys.stderr)
+        code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        conn.sendall(EXIT_MARKER + str(code).encode() + b'\n')
+        conn.close()
+        os._exit(code)
+
+
+def serve(socket_path=DEFAULT_SOCKET, preload=None):
+    """ Resident daemon: import the subcommand modules once and fork a warm child per job received on socket_path.
+        The child inherits the already imported modules, so a job does not pay for the imports. Nothing else is kept
+        warm: postgres connections and PACS associations cannot be shared with forked children, so every job still
+        opens its own
+    """
+    parser = build_parser()
+    for name in (preload if preload is not None else sorted(COMMANDS)):
+        module = COMMANDS[name][0]
+        try:
+            importlib.import_module(module)
+        except Exception as e:
+            print(f"Could not preload {module}: {e}")
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    os.chmod(socket_path, 0o600)  # jobs run with the daemon user's privileges and the client's environment
+    server.listen(16)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)  # reap finished jobs automatically
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # remove the socket on shutdown
+    print(f"dicomtk daemon listening on {socket_path}")
+
+    try:
+        while True:
+            conn, _ = server.accept()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            if os.fork() == 0:
+                server.close()
+                _run_job(conn, parser)
+            conn.close()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def submit(socket_path, argv):
+    """ Send a job to a running daemon and stream its output. Returns the exit code or None if no daemon runs """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except OSError:
+        client.close()
+        return None
+
+    request = {'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ)}
+    client.sendall(json.dumps(request).encode() + b'\n')
+    code = 1
+    pending = b''
+    out = sys.stdout.buffer
+    while True:
+        chunk = client.recv(65536)
+        if not chunk:
+            break
+        pending += chunk
+        marker = pending.find(EXIT_MARKER)
+        if marker != -1:
+            out.write(pending[:marker])
+            code = int(pending[marker + len(EXIT_MARKER):].split(b'\n')[0] or 1)
+            break
+        # Keep a tail that could be the start of a split exit marker
+        out.write(pending[:-len(EXIT_MARKER)])
+        pending = pending[-len(EXIT_MARKER):]
+        out.flush()
+    out.flush()
+    client.close()
+    return code
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if args.command == 'daemon':
+        serve(args.socket, args.preload)
+    elif args.command == 'import-times':
+        measure_import_times(args.repeat)
+    else:
+        if not args.no_daemon:
+            code = submit(args.socket, argv)
+            if code is not None:
+                sys.exit(code)
+        run_command(args)
+
+
+if __name__ == '__main__':
+    main()
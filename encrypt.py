@@ -3,6 +3,11 @@ import sys
 import zlib
 from cryptography.fernet import Fernet
 import pydicom
+from dicom_scan import scan_dicom
+from pseudonym import PSEUDONYM_TAG, load_pseudonym_key, pseudonymize, open_index, add_to_index
+
+
+ANONYMIZED = 'anonymized data'  # placeholder written over the encrypted PatientName and PatientID
 
 
 def encrypt_data(data, key):
@@ -13,31 +18,71 @@ def encrypt_data(data, key):
     return compressed_data
 
 
-def encrypt(folder_path):
+def is_encrypted(ds, tag, keyword):
+    """True if the attribute (e.g. PatientID) holds the placeholder and its encrypted value is stored in tag."""
+    return tag in ds and str(getattr(ds, keyword, '')) == ANONYMIZED
+
+
+def encrypt_file(dicom_path, key, pseudonym_key=None, index=None):
+    """Encrypt PatientName and PatientID in a single dicom file.
+    If pseudonym_key is given, a deterministic patient pseudonym is also written and recorded in the index.
+    Returns False if the file was already encrypted (it is left unchanged), True otherwise."""
+    ds = pydicom.dcmread(dicom_path)
+    name_encrypted = is_encrypted(ds, (0x1001, 0x0010), 'PatientName')
+    id_encrypted = is_encrypted(ds, (0x1001, 0x0020), 'PatientID')
+    name_done = name_encrypted or not hasattr(ds, 'PatientName')
+    id_done = id_encrypted or not hasattr(ds, 'PatientID')
+    if (name_encrypted or id_encrypted) and name_done and id_done:
+        # Encrypting again (e.g. a retried queue job) would replace the encrypted PatientName and PatientID with the
+        # encryption of the placeholder. Only make sure the file is indexed, in case that failed the first time
+        if PSEUDONYM_TAG in ds and index is not None:
+            add_to_index(index, ds[PSEUDONYM_TAG].value, dicom_path)
+            index.commit()
+        return False
+    patient_pseudonym = None
+    if not name_done:
+        ds.add_new((0x1001, 0x0010), 'OB', encrypt_data(ds.PatientName, key))  # patient name
+        ds.PatientName = ANONYMIZED
+    if not id_done:
+        if pseudonym_key:
+            patient_pseudonym = pseudonymize(ds.PatientID, pseudonym_key)
+            ds.add_new(PSEUDONYM_TAG, 'LO', patient_pseudonym)  # patient pseudonym
+        ds.add_new((0x1001, 0x0020), 'OB', encrypt_data(ds.PatientID, key))  # patient ID
+        ds.PatientID = ANONYMIZED
+    ds.save_as(dicom_path)
+    if patient_pseudonym and index is not None:
+        add_to_index(index, patient_pseudonym, dicom_path)
+        index.commit()  # per file, so the index never misses a file that was already rewritten
+    return True
+
+
+def encrypt(folder_path, index_path=None):
     """Encrypt PatientName and PatientID in all dicom files in folder_path."""
     key = os.getenv('AES_KEY')  # load AES key
     if not key:
         raise EnvironmentError("AES_KEY environment variable not set.")
+    pseudonym_key = load_pseudonym_key()  # load HMAC key for patient pseudonyms
+    if not pseudonym_key:
+        print("PSEUDONYM_KEY environment variable not set, patient pseudonyms will not be written.")
 
-    for entry in os.listdir(folder_path):
-        dicom_path = os.path.join(folder_path, entry)
-        if os.path.isfile(dicom_path):
+    index = open_index(index_path) if pseudonym_key else None
+    try:
+        for dicom_path in scan_dicom(folder_path, recursive=False):
             try:
-                ds = pydicom.dcmread(dicom_path)
-                if hasattr(ds, 'PatientName'):
-                    ds.add_new((0x1001, 0x0010), 'OB', encrypt_data(ds.PatientName, key))  # patient name
-                    ds.PatientName = 'anonymized data'
-                if hasattr(ds, 'PatientID'):
-                    ds.add_new((0x1001, 0x0020), 'OB', encrypt_data(ds.PatientID, key))  # patient ID
-                    ds.PatientID = 'anonymized data'
-                ds.save_as(dicom_path)
-                print(f"Encrypted {dicom_path}")
+                if encrypt_file(dicom_path, key, pseudonym_key, index):
+                    print(f"Encrypted {dicom_path}")
+                else:
+                    print(f"Already encrypted, skipped {dicom_path}")
             except Exception as e:
                 print(f"Failed to process {dicom_path}: {str(e)}")
+    finally:
+        if index is not None:
+            index.commit()
+            index.close()
 
 
 if __name__ == '__main__':
     if len(sys.argv) > 1:
-        encrypt(sys.argv[1])
+        encrypt(*sys.argv[1:3])
     else:
         print("Please provide dicom folder.")
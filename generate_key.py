@@ -1,7 +1,15 @@
 from cryptography.fernet import Fernet
 
-# Generate a key
-key = Fernet.generate_key()
 
-# Print the generated key
-print("Generated Key:", key.decode())
+
+def generate_key():
+    """Generate and print a new Fernet key."""
+    # Generate a key
+    key = Fernet.generate_key()
+
+    # Print the generated key
+    print("Generated Key:", key.decode())
+
+
+if __name__ == '__main__':
+    generate_key()
@@ -1,15 +1,15 @@
 import os
+import argparse
 import pandas as pd
 import pydicom
 from datetime import datetime
 from dateutil import parser
+from dicom_scan import scan_dicom
+from birads_table import load_birads_table
 
 def read_excel(file_path):
-    # Load the Excel file
-    df = pd.read_excel(file_path, dtype={'JMBG': str})
-    # Convert 'Vreme kreiranja' to datetime
-    df['Vreme kreiranja'] = pd.to_datetime(df['Vreme kreiranja'], errors='coerce')
-    return df
+    # Load the needed columns of the Excel file ('Vreme kreiranja' already converted to datetime, cached as Parquet)
+    return load_birads_table(file_path)
 
 def find_closest_date(target, dates):
     # Filter dates to only include those on or before the target date
@@ -20,60 +20,113 @@ def find_closest_date(target, dates):
     else:
         return None  # Return None if no valid date found
 
+def group_screenings(info_df):
+    # Group screenings by patient once, with 'Vreme kreiranja' as date only for comparison
+    info_df = info_df.assign(**{'Vreme kreiranja': info_df['Vreme kreiranja'].dt.date})
+    return {patient_id: group for patient_id, group in info_df.groupby('JMBG')}
+
+def match_screening(patient_groups, patient_id, study_date, laterality):
+    # Closest screening of the patient on or before study_date and its BIRADS for laterality ('L' or 'R').
+    # Returns (date, birads) or None if the patient has no screening on or before study_date
+    patient_info = patient_groups.get(patient_id)
+    if patient_info is None:
+        return None
+    closest_date = find_closest_date(study_date, patient_info['Vreme kreiranja'])
+    if not closest_date:
+        return None
+    closest_row = patient_info[patient_info['Vreme kreiranja'] == closest_date]
+    if laterality == 'L':
+        birads = closest_row['BIRADS L'].values[0]
+    elif laterality == 'R':
+        birads = closest_row['BIRADS D'].values[0]
+    else:
+        birads = 'Unknown'
+    return closest_date, birads
+
 def process_dicom_files(directory, info_df):
     results = []
+    patient_groups = group_screenings(info_df)
     # Traverse the directory containing subfolders for each patient
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            filepath = os.path.join(root, file)
-            try:
-                # Read DICOM file
-                ds = pydicom.dcmread(filepath, stop_before_pixels=True)
-                study_date = datetime.strptime(ds.StudyDate, '%Y%m%d').date()
-                patient_id = os.path.basename(root)
-                image_id = file
+    for filepath in scan_dicom(directory):
+        file = os.path.basename(filepath)
+        try:
+            # Read DICOM file
+            ds = pydicom.dcmread(filepath, stop_before_pixels=True)
+            study_date = datetime.strptime(ds.StudyDate, '%Y%m%d').date()
+            patient_id = os.path.basename(os.path.dirname(filepath))
+            image_id = file
 
-                # Filter info_df for current patient_id
-                patient_info = info_df[info_df['JMBG'] == patient_id]
-                # Make sure 'Vreme kreiranja' is treated as date only for comparison
-                patient_info['Vreme kreiranja'] = patient_info['Vreme kreiranja'].dt.date
+            # Assume images are named or tagged with L or R for left/right breast
+            laterality = 'L' if 'L' in file.upper() else 'R' if 'R' in file.upper() else None
 
-                # Get the closest screening date from the patient-specific data
-                closest_date = find_closest_date(study_date, patient_info['Vreme kreiranja'])
-                if closest_date:
-                    closest_row = patient_info[patient_info['Vreme kreiranja'] == closest_date]
+            match = match_screening(patient_groups, patient_id, study_date, laterality)
+            if match:
+                closest_date, birads = match
+                results.append([patient_id, image_id, closest_date.strftime('%Y-%m-%d'), birads])
+            else:
+                print(f"No valid screening date found for {filepath}")
+        except Exception as e:
+            print(f"Error processing {filepath}: {e}")
+    return results
 
-                    # Assume images are named or tagged with L or R for left/right breast
-                    if 'L' in file.upper():
-                        birads = closest_row['BIRADS L'].values[0]
-                    elif 'R' in file.upper():
-                        birads = closest_row['BIRADS D'].values[0]
-                    else:
-                        birads = 'Unknown'
+def process_lake_records(info_df, start_month=None, end_month=None):
+    import metadata_lake  # pyarrow is only needed for reports from the lake
+    results = []
+    patient_groups = group_screenings(info_df)
+    # Read only the needed columns and months from the metadata lake instead of every DICOM header
+    records = metadata_lake.query(['patient_id', 'mammography_id', 'acquisition_date', 'laterality'],
+                                  start_month, end_month).drop_duplicates('mammography_id')
+    for patient_id, image_id, acquisition_date, laterality in zip(records['patient_id'], records['mammography_id'],
+                                                                   records['acquisition_date'], records['laterality']):
+        try:
+            study_date = datetime.strptime(acquisition_date.strip(), '%Y%m%d').date()
 
-                    results.append([patient_id, image_id, closest_date.strftime('%Y-%m-%d'), birads])
-                else:
-                    print(f"No valid screening date found for {filepath}")
-            except Exception as e:
-                print(f"Error processing {filepath}: {e}")
+            # Laterality comes from the ImageLaterality tag
+            match = match_screening(patient_groups, patient_id, study_date, laterality.strip().upper())
+            if match:
+                closest_date, birads = match
+                results.append([patient_id, image_id, closest_date.strftime('%Y-%m-%d'), birads])
+            else:
+                print(f"No valid screening date found for {image_id}")
+        except Exception as e:
+            print(f"Error processing {image_id}: {e}")
     return results
 
-def main():
-    info_path = 'path_to_info.xls'
-    dicom_directory = 'path_to_dicom_directory'
-    output_path = 'output.csv'
+def save_results(result_data, output_path):
+    # Create DataFrame and save to CSV
+    columns = ['PatientID', 'ImageID', 'Date', 'BIRADS']
+    result_df = pd.DataFrame(result_data, columns=columns)
+    result_df.to_csv(output_path, index=False)
+    print(f"Output saved to {output_path}")
 
+def main(info_path='path_to_info.xls', dicom_directory='path_to_dicom_directory', output_path='output.csv'):
     # Load and process the Excel data
     info_df = read_excel(info_path)
 
     # Process each DICOM file and gather results
     result_data = process_dicom_files(dicom_directory, info_df)
 
-    # Create DataFrame and save to CSV
-    columns = ['PatientID', 'ImageID', 'Date', 'BIRADS']
-    result_df = pd.DataFrame(result_data, columns=columns)
-    result_df.to_csv(output_path, index=False)
-    print(f"Output saved to {output_path}")
+    save_results(result_data, output_path)
+
+def lake_report(info_path, output_path, start_month=None, end_month=None):
+    # Same report, but built from the metadata lake (METADATA_LAKE) for the given months (YYYY-MM)
+    info_df = read_excel(info_path)
+    result_data = process_lake_records(info_df, start_month, end_month)
+    save_results(result_data, output_path)
 
 if __name__ == "__main__":
-    main()
+    arg_parser = argparse.ArgumentParser(description='Match DICOM images with the closest BIRADS screening.')
+    arg_parser.add_argument('paths', nargs='+',
+                            help='<info_path> <dicom_directory> <output_path> (<info_path> <output_path> with --lake)')
+    arg_parser.add_argument('--lake', action='store_true', help='Read the images from the metadata lake')
+    arg_parser.add_argument('--start-month', help='First month (YYYY-MM) read from the lake')
+    arg_parser.add_argument('--end-month', help='Last month (YYYY-MM) read from the lake')
+    args = arg_parser.parse_args()
+    if args.lake:
+        if len(args.paths) != 2:
+            arg_parser.error('--lake expects <info_path> <output_path>')
+        lake_report(*args.paths, start_month=args.start_month, end_month=args.end_month)
+    else:
+        if len(args.paths) != 3:
+            arg_parser.error('expected <info_path> <dicom_directory> <output_path>')
+        main(*args.paths)
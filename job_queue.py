@@ -0,0 +1,337 @@
+import os
+import time
+import socket
+import argparse
+import multiprocessing
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+from utils import load_db_params
+from dicom_scan import scan_dicom
+
+
+# Postgres job queue: producers enqueue file paths, any number of workers on any host claim batches of them with
+# SELECT ... FOR UPDATE SKIP LOCKED. Paths must be reachable from every worker host (e.g. a shared NFS archive).
+JOBS_TABLE = 'dicom_jobs'
+DEFAULT_BATCH_SIZE = 10
+DEFAULT_LEASE_SECONDS = 600     # a claimed job whose worker did not report back within this time is claimed again
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_POLL_SECONDS = 5
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id bigserial PRIMARY KEY,
+        queue text NOT NULL,
+        payload text NOT NULL,
+        status text NOT NULL DEFAULT 'pending',  -- pending, running, done, failed
+        attempts integer NOT NULL DEFAULT 0,
+        max_attempts integer NOT NULL DEFAULT 3,
+        leased_until timestamptz,
+        worker text,
+        last_error text,
+        created_at timestamptz NOT NULL DEFAULT now(),
+        updated_at timestamptz NOT NULL DEFAULT now(),
+        UNIQUE (queue, payload)
+    );
+    CREATE INDEX IF NOT EXISTS {claim_index} ON {table} (queue, status, id);
+
+    -- Progress per queue
+    CREATE OR REPLACE VIEW {progress_view} AS
+    SELECT queue,
+           COUNT(*) FILTER (WHERE status = 'pending') AS pending,
+           COUNT(*) FILTER (WHERE status = 'running') AS running,
+           COUNT(*) FILTER (WHERE status = 'done') AS done,
+           COUNT(*) FILTER (WHERE status = 'failed') AS failed,
+           COUNT(*) FILTER (WHERE status = 'done' AND updated_at > now() - interval '1 minute') AS done_last_minute,
+           MAX(updated_at) FILTER (WHERE status = 'done') AS last_done
+    FROM {table}
+    GROUP BY queue;
+
+    -- Throughput per worker (host:pid)
+    CREATE OR REPLACE VIEW {workers_view} AS
+    SELECT queue, worker,
+           COUNT(*) FILTER (WHERE status = 'running') AS running,
+           COUNT(*) FILTER (WHERE status = 'done') AS done,
+           COUNT(*) FILTER (WHERE status = 'done' AND updated_at > now() - interval '1 minute') AS done_last_minute,
+           MAX(updated_at) AS last_seen
+    FROM {table}
+    WHERE worker IS NOT NULL
+    GROUP BY queue, worker;
+"""
+
+
+def connect():
+    """ Autocommit connection, every queue operation is its own short transaction """
+    conn = psycopg2.connect(**load_db_params())
+    conn.autocommit = True
+    return conn
+
+
+def init_schema(conn):
+    """ Create the jobs table and the progress views (if they do not exist) """
+    with conn.cursor() as cursor:
+        cursor.execute(sql.SQL(SCHEMA).format(table=sql.Identifier(JOBS_TABLE),
+                                              claim_index=sql.Identifier(f'{JOBS_TABLE}_claim'),
+                                              progress_view=sql.Identifier(f'{JOBS_TABLE}_progress'),
+                                              workers_view=sql.Identifier(f'{JOBS_TABLE}_workers')))
+
+
+def enqueue_paths(conn, queue, paths, max_attempts=DEFAULT_MAX_ATTEMPTS, chunk_size=1000):
+    """ Add jobs for paths to queue. Paths that were already enqueued are skipped. Returns the number of new jobs """
+    query = sql.SQL("""
+        INSERT INTO {table} (queue, payload, max_attempts) VALUES %s
+        ON CONFLICT (queue, payload) DO NOTHING
+        RETURNING id
+    """).format(table=sql.Identifier(JOBS_TABLE))
+    added = 0
+    chunk = []
+    with conn.cursor() as cursor:
+        for path in paths:
+            chunk.append((queue, os.path.abspath(path), max_attempts))
+            if len(chunk) == chunk_size:
+                added += len(execute_values(cursor, query, chunk, fetch=True))
+                chunk = []
+        if chunk:
+            added += len(execute_values(cursor, query, chunk, fetch=True))
+    return added
+
+
+def claim(conn, queue, worker, batch_size=DEFAULT_BATCH_SIZE, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """ Claim up to batch_size pending (or lease-expired) jobs. Rows locked by other workers are skipped, so any
+        number of workers can claim concurrently without waiting on each other. Returns [(id, payload), ...]
+    """
+    with conn.cursor() as cursor:
+        # Jobs whose lease expired on their last attempt are not retried
+        cursor.execute(sql.SQL("""
+            UPDATE {table} SET status = 'failed', last_error = 'lease expired', updated_at = now()
+            WHERE queue = %s AND status = 'running' AND leased_until < now() AND attempts >= max_attempts
+        """).format(table=sql.Identifier(JOBS_TABLE)), (queue,))
+
+        cursor.execute(sql.SQL("""
+            WITH claimed AS (
+                SELECT id FROM {table}
+                WHERE queue = %s
+                  AND (status = 'pending' OR (status = 'running' AND leased_until < now()))
+                  AND attempts < max_attempts
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE {table} AS jobs
+            SET status = 'running', attempts = jobs.attempts + 1, worker = %s, updated_at = now(),
+                leased_until = now() + %s * interval '1 second'
+            FROM claimed
+            WHERE jobs.id = claimed.id
+            RETURNING jobs.id, jobs.payload
+        """).format(table=sql.Identifier(JOBS_TABLE)), (queue, batch_size, worker, lease_seconds))
+        return sorted(cursor.fetchall())
+
+
+def renew_lease(conn, job_ids, worker, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """ Extend the lease of jobs still held by worker """
+    with conn.cursor() as cursor:
+        cursor.execute(sql.SQL("""
+            UPDATE {table} SET leased_until = now() + %s * interval '1 second'
+            WHERE id = ANY(%s) AND worker = %s AND status = 'running'
+        """).format(table=sql.Identifier(JOBS_TABLE)), (lease_seconds, list(job_ids), worker))
+
+
+def complete(conn, job_id, worker):
+    """ Mark a job as done (only if worker still holds it) """
+    with conn.cursor() as cursor:
+        cursor.execute(sql.SQL("""
+            UPDATE {table} SET status = 'done', leased_until = NULL, last_error = NULL, updated_at = now()
+            WHERE id = %s AND worker = %s AND status = 'running'
+        """).format(table=sql.Identifier(JOBS_TABLE)), (job_id, worker))
+
+
+def fail(conn, job_id, worker, error):
+    """ Put a failed job back to pending, or mark it as failed once it used up its attempts """
+    with conn.cursor() as cursor:
+        cursor.execute(sql.SQL("""
+            UPDATE {table}
+            SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'pending' END,
+                leased_until = NULL, last_error = %s, updated_at = now()
+            WHERE id = %s AND worker = %s AND status = 'running'
+        """).format(table=sql.Identifier(JOBS_TABLE)), (error, job_id, worker))
+
+
+def retry_failed(conn, queue):
+    """ Give all failed jobs of queue a fresh set of attempts """
+    with conn.cursor() as cursor:
+        cursor.execute(sql.SQL("""
+            UPDATE {table} SET status = 'pending', attempts = 0, last_error = NULL, updated_at = now()
+            WHERE queue = %s AND status = 'failed'
+        """).format(table=sql.Identifier(JOBS_TABLE)), (queue,))
+        return cursor.rowcount
+
+
+def png_handler(crop=False):
+    """ Worker for the 'png' queue: dicom -> .png in minio + metadata in postgres (and the metadata lake) """
+    from dicom_to_png import minio_client, dicom_to_minio
+    client = minio_client()
+    if not os.getenv('METADATA_LAKE'):
+        return lambda path: dicom_to_minio(path, client, crop), lambda final: None
+    import metadata_lake
+    lake_rows = []
+
+    def handle(path):
+        row = dicom_to_minio(path, client, crop)
+        if row is not None:  # only rows that were inserted now, so retried jobs add no duplicates
+            lake_rows.append(row)
+
+    def flush(final):
+        # Job batches are small; lake files are only written every LAKE_BATCH_SIZE rows and when the worker stops
+        if final or len(lake_rows) >= metadata_lake.LAKE_BATCH_SIZE:
+            metadata_lake.try_write_batch(lake_rows)
+            del lake_rows[:]
+    return handle, flush
+
+
+def encrypt_handler(**options):
+    """ Worker for the 'encrypt' queue: encrypt PatientName/PatientID and index the patient pseudonym in the pseudonyms
+        table in postgres, so the index covers the files encrypted on every host. Already encrypted files (retried or
+        re-claimed jobs) are left unchanged
+    """
+    from encrypt import encrypt_file
+    from pseudonym import POSTGRES_INDEX, load_pseudonym_key, open_index
+    key = os.getenv('AES_KEY')  # load AES key
+    if not key:
+        raise EnvironmentError("AES_KEY environment variable not set.")
+    pseudonym_key = load_pseudonym_key()
+    index = open_index(POSTGRES_INDEX) if pseudonym_key else None
+
+    def flush(final):
+        # encrypt_file commits the index after every file
+        if final and index is not None:
+            index.close()
+    return lambda path: encrypt_file(path, key, pseudonym_key, index), flush
+
+
+# queue name: function(**options) returning (handler(path), flush(final) called after each batch and at the end)
+HANDLERS = {
+    'png': png_handler,
+    'encrypt': encrypt_handler,
+}
+
+
+def work(queue, batch_size=DEFAULT_BATCH_SIZE, lease_seconds=DEFAULT_LEASE_SECONDS,
+         poll_seconds=DEFAULT_POLL_SECONDS, exit_when_empty=False, crop=False):
+    """ Claim and process batches of jobs from queue until stopped (or until the queue is empty) """
+    if queue not in HANDLERS:
+        raise ValueError(f"Unknown queue {queue}, expected one of {', '.join(sorted(HANDLERS))}")
+    handler, flush = HANDLERS[queue](crop=crop)
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    conn = connect()
+    processed = 0
+    print(f"Worker {worker} started on queue {queue}")
+
+    try:
+        while True:
+            jobs = claim(conn, queue, worker, batch_size, lease_seconds)
+            if not jobs:
+                if exit_when_empty:
+                    break
+                time.sleep(poll_seconds)
+                continue
+
+            for i, (job_id, path) in enumerate(jobs):
+                try:
+                    handler(path)
+                    complete(conn, job_id, worker)
+                    processed += 1
+                except Exception as e:
+                    print(f"Failed to process {path}: {e}")
+                    fail(conn, job_id, worker, str(e))
+                # Keep the rest of the batch from being handed to another worker while this one is still busy
+                remaining = [remaining_id for remaining_id, _ in jobs[i + 1:]]
+                if remaining:
+                    renew_lease(conn, remaining, worker, lease_seconds)
+            flush(False)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        flush(True)
+        conn.close()
+    print(f"Worker {worker} processed {processed} jobs")
+    return processed
+
+
+def run_workers(queue, processes=1, batch_size=DEFAULT_BATCH_SIZE, lease_seconds=DEFAULT_LEASE_SECONDS,
+                poll_seconds=DEFAULT_POLL_SECONDS, exit_when_empty=False, crop=False):
+    """ Run processes workers for queue on this host """
+    if processes <= 1:
+        work(queue, batch_size, lease_seconds, poll_seconds, exit_when_empty, crop)
+        return
+    workers = [multiprocessing.Process(target=work, args=(queue, batch_size, lease_seconds, poll_seconds,
+                                                           exit_when_empty, crop))
+               for _ in range(processes)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+
+
+def enqueue(queue, folder, recursive=True, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """ Enqueue every DICOM file under folder """
+    conn = connect()
+    try:
+        init_schema(conn)
+        added = enqueue_paths(conn, queue, scan_dicom(folder, recursive=recursive), max_attempts)
+    finally:
+        conn.close()
+    print(f"Enqueued {added} new jobs on queue {queue}")
+
+
+def print_progress(queue=None, retry=False):
+    """ Print the progress view (and optionally retry failed jobs of queue) """
+    conn = connect()
+    try:
+        if retry and queue:
+            print(f"Retrying {retry_failed(conn, queue)} failed jobs on queue {queue}")
+        with conn.cursor() as cursor:
+            query = "SELECT queue, pending, running, done, failed, done_last_minute, last_done FROM {view}"
+            params = ()
+            if queue:
+                query += " WHERE queue = %s"
+                params = (queue,)
+            cursor.execute(sql.SQL(query).format(view=sql.Identifier(f'{JOBS_TABLE}_progress')), params)
+            print(f"{'queue':<10}{'pending':>10}{'running':>10}{'done':>10}{'failed':>10}{'done/min':>10}  last done")
+            for row in cursor.fetchall():
+                print(f"{row[0]:<10}{row[1]:>10}{row[2]:>10}{row[3]:>10}{row[4]:>10}{row[5]:>10}  {row[6]}")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Distribute png/encrypt work over several hosts via postgres.')
+    subparsers = arg_parser.add_subparsers(dest='action')
+    subparsers.required = True
+
+    enqueue_parser = subparsers.add_parser('enqueue', help='Enqueue all DICOM files of a folder')
+    enqueue_parser.add_argument('queue', choices=sorted(HANDLERS))
+    enqueue_parser.add_argument('folder')
+    enqueue_parser.add_argument('--no-recursive', dest='recursive', action='store_false')
+    enqueue_parser.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS)
+
+    work_parser = subparsers.add_parser('work', help='Process jobs of a queue')
+    work_parser.add_argument('queue', choices=sorted(HANDLERS))
+    work_parser.add_argument('--processes', type=int, default=1, help='Worker processes on this host')
+    work_parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    work_parser.add_argument('--lease-seconds', type=int, default=DEFAULT_LEASE_SECONDS)
+    work_parser.add_argument('--poll-seconds', type=float, default=DEFAULT_POLL_SECONDS)
+    work_parser.add_argument('--exit-when-empty', action='store_true')
+    work_parser.add_argument('--crop', action='store_true', help='png queue: crop images to the breast')
+
+    progress_parser = subparsers.add_parser('progress', help='Show queue progress')
+    progress_parser.add_argument('queue', nargs='?')
+    progress_parser.add_argument('--retry-failed', dest='retry', action='store_true')
+
+    args = arg_parser.parse_args()
+    if args.action == 'enqueue':
+        enqueue(args.queue, args.folder, args.recursive, args.max_attempts)
+    elif args.action == 'work':
+        run_workers(args.queue, args.processes, args.batch_size, args.lease_seconds, args.poll_seconds,
+                    args.exit_when_empty, args.crop)
+    else:
+        print_progress(args.queue, args.retry)
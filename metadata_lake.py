@@ -0,0 +1,212 @@
+import os
+import time
+import uuid
+import argparse
+import psycopg2
+from psycopg2 import sql
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pyarrow import fs
+from utils import load_env, load_db_params
+
+
+# Date-partitioned Parquet copy of the dicom_metadata rows written by dicom_to_png, for analytics that should not scan
+# the postgres table png_to_minio writes to. Partitioned hive-style by acquisition month:
+#   <lake>/acquisition_month=2024-05/part-<time>-<uuid>.parquet
+# The lake is a local directory or a minio location (s3://bucket/prefix, using the MINIO_* environment variables).
+LAKE_ENV = 'METADATA_LAKE'
+LAKE_BATCH_SIZE = 500   # rows buffered before a file is written
+COMPACT_MIN_FILES = 8   # partitions with at least this many files are merged into one
+PARTITION_COLUMN = 'acquisition_month'
+COLUMNS = ['mammography_id', 'patient_name', 'patient_id', 'acquisition_date', 'acquisition_time', 'view',
+           'laterality', 'implant', 'manufacturer', 'manufacturer_model', 'institution', 'sop_instance_uid',
+           'crop_box']
+SCHEMA = pa.schema([(column, pa.string()) for column in COLUMNS])
+
+
+def lake_location():
+    """ Lake location from the METADATA_LAKE environment variable, or None if the lake is not enabled """
+    return os.getenv(LAKE_ENV) or None
+
+
+def _filesystem(location):
+    """ (filesystem, path) for a local directory or an s3://bucket/prefix location on minio """
+    if not location:
+        raise EnvironmentError(f"{LAKE_ENV} environment variable not set.")
+    if location.startswith('s3://'):
+        minio_host = load_env('MINIO_HOST')
+        s3 = fs.S3FileSystem(access_key=load_env('MINIO_ACC_KEY'), secret_key=load_env('MINIO_SECRET_KEY'),
+                             endpoint_override=minio_host, scheme='http')
+        return s3, location[len('s3://'):].rstrip('/')
+    return fs.LocalFileSystem(), os.path.abspath(location)
+
+
+def _partition(acquisition_date):
+    """ Partition value (YYYY-MM) of a DICOM date (YYYYMMDD) """
+    date = str(acquisition_date or '').strip()
+    if len(date) == 8 and date.isdigit():
+        return f'{date[:4]}-{date[4:6]}'
+    return 'unknown'
+
+
+def write_batch(rows, location=None):
+    """ Append metadata rows (dicts with the COLUMNS keys) to the lake, one new file per acquisition month """
+    location = location or lake_location()
+    if not rows or not location:
+        return
+    filesystem, root = _filesystem(location)
+
+    partitions = {}
+    for row in rows:
+        partitions.setdefault(_partition(row.get('acquisition_date')), []).append(row)
+
+    for month, month_rows in partitions.items():
+        directory = f'{root}/{PARTITION_COLUMN}={month}'
+        filesystem.create_dir(directory, recursive=True)
+        table = pa.Table.from_pydict({column: [None if row.get(column) is None else str(row.get(column))
+                                               for row in month_rows] for column in COLUMNS}, schema=SCHEMA)
+        pq.write_table(table, f'{directory}/part-{int(time.time())}-{uuid.uuid4().hex}.parquet',
+                       filesystem=filesystem)
+    print(f"Wrote {len(rows)} metadata rows to {location}")
+
+
+def try_write_batch(rows, location=None):
+    """ write_batch that logs errors instead of raising: the lake is a secondary copy and must not stop the png
+        conversion. Rows that could not be written can be added later with backfill
+    """
+    try:
+        write_batch(rows, location)
+    except Exception as e:
+        print(f"Could not write {len(rows)} metadata rows to the metadata lake (run backfill to add them): {e}")
+
+
+def backfill(start_month=None, end_month=None, table_name='dicom_metadata', location=None,
+             batch_size=LAKE_BATCH_SIZE * 20):
+    """ Export the rows of the postgres table (acquisition months start_month to end_month, YYYY-MM, inclusive) to
+        the lake, e.g. for the existing history or after lake writes failed. Rows already in the lake are appended
+        again; queries and compact keep one row per mammography_id
+    """
+    location = location or lake_location()
+    _filesystem(location)  # fail early if the lake is not configured
+    conn = psycopg2.connect(**load_db_params())
+    try:
+        with conn.cursor() as cursor:
+            # Tables created before a column was added (e.g. crop_box) are exported with that column empty
+            cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_name = %s", (table_name,))
+            existing = {row[0] for row in cursor.fetchall()}
+        columns = [column for column in COLUMNS if column in existing]
+
+        conditions, params = [], []
+        if start_month:
+            conditions.append(sql.SQL("LEFT(acquisition_date, 6) >= %s"))
+            params.append(start_month.replace('-', ''))
+        if end_month:
+            conditions.append(sql.SQL("LEFT(acquisition_date, 6) <= %s"))
+            params.append(end_month.replace('-', ''))
+        query = sql.SQL("SELECT {columns} FROM {table}").format(
+            columns=sql.SQL(', ').join(sql.Identifier(column) for column in columns),
+            table=sql.Identifier(table_name))
+        if conditions:
+            query = query + sql.SQL(" WHERE ") + sql.SQL(" AND ").join(conditions)
+
+        exported = 0
+        with conn.cursor(name='metadata_lake_backfill') as cursor:  # server side cursor, rows are streamed
+            cursor.itersize = batch_size
+            cursor.execute(query, params)
+            while True:
+                records = cursor.fetchmany(batch_size)
+                if not records:
+                    break
+                write_batch([dict(zip(columns, record)) for record in records], location)
+                exported += len(records)
+        print(f"Exported {exported} rows of {table_name} to {location}")
+    finally:
+        conn.close()
+
+
+def compact(location=None, min_files=COMPACT_MIN_FILES):
+    """ Merge the files of every partition that has at least min_files files into a single file, keeping one row per
+        mammography_id. The merged file is written before the small ones are removed, so no rows are ever missing
+        from the lake
+    """
+    location = location or lake_location()
+    filesystem, root = _filesystem(location)
+    for partition in filesystem.get_file_info(fs.FileSelector(root, allow_not_found=True)):
+        if partition.type != fs.FileType.Directory:
+            continue
+        files = [info.path for info in filesystem.get_file_info(fs.FileSelector(partition.path))
+                 if info.type == fs.FileType.File and info.path.endswith('.parquet')]
+        if len(files) < min_files:
+            continue
+        table = ds.dataset(files, schema=SCHEMA, filesystem=filesystem, format='parquet').to_table()
+        df = table.to_pandas().drop_duplicates('mammography_id', keep='last')
+        table = pa.Table.from_pandas(df, schema=SCHEMA, preserve_index=False)
+        pq.write_table(table, f'{partition.path}/part-{int(time.time())}-{uuid.uuid4().hex}-compacted.parquet',
+                       filesystem=filesystem)
+        for path in files:
+            filesystem.delete_file(path)
+        print(f"Compacted {len(files)} files ({table.num_rows} rows) in {partition.base_name}")
+
+
+def query(columns=None, start_month=None, end_month=None, extra_filter=None, location=None):
+    """ Read the lake into a pandas DataFrame, scanning only the given columns and the partitions (YYYY-MM, inclusive)
+        between start_month and end_month. extra_filter is an optional pyarrow.dataset expression
+    """
+    location = location or lake_location()
+    filesystem, root = _filesystem(location)
+    dataset = ds.dataset(root, filesystem=filesystem, format='parquet',
+                         partitioning=ds.partitioning(pa.schema([(PARTITION_COLUMN, pa.string())]), flavor='hive'))
+    expression = None
+    if start_month:
+        expression = ds.field(PARTITION_COLUMN) >= start_month
+    if end_month:
+        end = ds.field(PARTITION_COLUMN) <= end_month
+        expression = end if expression is None else expression & end
+    if start_month or end_month:
+        # 'unknown' (rows without acquisition date) would compare as later than any month
+        known = ds.field(PARTITION_COLUMN) != 'unknown'
+        expression = expression & known
+    if extra_filter is not None:
+        expression = extra_filter if expression is None else expression & extra_filter
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+
+def monthly_counts(by, start_month=None, end_month=None, location=None):
+    """ Number of images per month and per the given columns (e.g. ['manufacturer', 'laterality']).
+        Images are counted once, also if a partition holds duplicate rows that were not compacted yet
+    """
+    columns = [PARTITION_COLUMN, 'mammography_id'] + [column for column in by if column != 'mammography_id']
+    df = query(columns, start_month, end_month, location=location).drop_duplicates('mammography_id')
+    return df.groupby([PARTITION_COLUMN] + list(by)).size().rename('images').reset_index()
+
+
+def print_counts(by, start_month=None, end_month=None):
+    """ Print monthly_counts as a table """
+    print(monthly_counts(by, start_month, end_month).to_string(index=False))
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Parquet metadata lake (location: METADATA_LAKE).')
+    subparsers = arg_parser.add_subparsers(dest='action')
+    subparsers.required = True
+
+    counts_parser = subparsers.add_parser('counts', help='Images per month and per the given columns')
+    counts_parser.add_argument('by', nargs='+', choices=COLUMNS)
+    counts_parser.add_argument('--start-month', help='YYYY-MM')
+    counts_parser.add_argument('--end-month', help='YYYY-MM')
+
+    compact_parser = subparsers.add_parser('compact', help='Merge small files of each partition')
+    compact_parser.add_argument('--min-files', type=int, default=COMPACT_MIN_FILES)
+
+    backfill_parser = subparsers.add_parser('backfill', help='Export dicom_metadata rows to the lake')
+    backfill_parser.add_argument('--start-month', help='YYYY-MM')
+    backfill_parser.add_argument('--end-month', help='YYYY-MM')
+
+    args = arg_parser.parse_args()
+    if args.action == 'counts':
+        print_counts(args.by, args.start_month, args.end_month)
+    elif args.action == 'backfill':
+        backfill(args.start_month, args.end_month)
+    else:
+        compact(min_files=args.min_files)
@@ -1,18 +1,20 @@
 import subprocess
 import sys
+from datetime import datetime, timedelta
 from utils import load_env
 
 
 def dwnld(initial_date, end_date):
     """Download all dicom MG images in the time span of initial_date - end_date"""
-    current_date = initial_date
+    current_date = datetime.strptime(str(initial_date), '%Y%m%d')
+    end_date = datetime.strptime(str(end_date), '%Y%m%d')
 
     # Retrieve PACS information from environment variables (IP, port, and AE title of the remote PACS server)
     pacs_ip = load_env('PACS_IP')
     pacs_port = load_env('PACS_PORT')
     pacs_ae_title = load_env('PACS_AE_TITLE')
 
-    while current_date != end_date+1:
+    while current_date <= end_date:
         # Define the command and parameters as a list
         command = [
             'movescu',
@@ -21,17 +23,17 @@ def dwnld(initial_date, end_date):
             pacs_ip, pacs_port,
             '-k', '0008,0052=SERIES',
             '-k', '0008,0016=1.2.840.10008.5.1.4.1.1.1.2',
-            '-k', '0008,0020='+str(current_date),
+            '-k', '0008,0020='+current_date.strftime('%Y%m%d'),
             '-d'
         ]
 
         # Execute the command
         try:
-            result = subprocess.run(command, check=True, text=True, capture_output=True)
-            current_date += 1
+            subprocess.run(command, check=True, text=True, capture_output=True)
         except subprocess.CalledProcessError as e:
             print("Error occurred:", e)
             print("Error output:", e.stderr)
+        current_date += timedelta(days=1)
 
 
 if __name__ == '__main__':
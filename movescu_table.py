@@ -1,8 +1,9 @@
 import pandas as pd
 import subprocess
-from datetime import datetime, timedelta
+from datetime import timedelta
 from utils import load_env
 from cp_latest import copy_latest_dicom
+from birads_table import load_birads_table
 import sys
 import os
 
@@ -12,9 +13,9 @@ def execute_movescu(patiendID, date, pacs_ae_title, pacs_ip, pacs_port):
     """Download patient dicom MG images based on patientID (jmbg) and report date (Vreme kreiranja)"""
     try:
         # Set beginning (3 months ago) and end (1 day ahead) dates
-        date_obj = datetime.strptime(date, '%Y-%m-%d %H:%M:%S')
+        date_obj = pd.to_datetime(date)
         beginning_date = date_obj - timedelta(days=90)
-        beginning_date = beginning_date.strftime('%Y%m%d'),
+        beginning_date = beginning_date.strftime('%Y%m%d')
         end_date = date_obj + timedelta(days=1)
         end_date = end_date.strftime('%Y%m%d')
 
@@ -39,17 +40,14 @@ def execute_movescu(patiendID, date, pacs_ae_title, pacs_ip, pacs_port):
         print("An unexpected error occurred:", str(e))
 
 
-if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        print("Usage: python3 movescu_table.py <excel_table_path>")
-        sys.exit(1)
-
+def process_table(excel_path):
+    """Download dicom MG images for the patients in the Excel table, keeping negative/positive BIRADS cases balanced"""
     # Create log file and redirect print statements to it
     log_filename = 'movescu_table.txt'
     f = open(log_filename, 'w', encoding='utf-8')
     sys.stdout = f
 
-    data = pd.read_excel(sys.argv[1], dtype={'JMBG': str})  # patient data
+    data = load_birads_table(excel_path)  # patient data
 
     # Retrieve PACS information from environment variables (IP, port, and AE title of the remote PACS server)
     pacs_ip = load_env('PACS_IP')
@@ -61,16 +59,11 @@ if __name__ == "__main__":
     birads_neg = 0
 
     # Iterate through each row (process one patient at a time)
-    for index, row in data.iterrows():
-        # Extract needed patient info (update column names based on your table)
-        patient_id = row['JMBG']
-        date = row['Vreme kreiranja']
-
+    # (update column names based on your table)
+    for patient_id, date, birads_l, birads_r in zip(data['JMBG'], data['Vreme kreiranja'], data['BIRADS L'],
+                                                     data['BIRADS D']):
         print(f"\nWorking on patient {patient_id}")
 
-        birads_l = str(row['BIRADS L']).strip()
-        birads_r = str(row['BIRADS D']).strip()
-
         if birads_l in ['2', '4', '4a', '4b', '4c', '5', '6'] or birads_r in ['2', '4', '4a', '4b', '4c', '5', '6']:
             if birads_l in ['4', '4a', '4b', '4c', '5', '6'] or birads_r in ['4', '4a', '4b', '4c', '5', '6'] or birads_neg < birads_pos + 10:
                 # download dicom
@@ -87,3 +80,13 @@ if __name__ == "__main__":
                 print(f"Number of occurrences with negative birads: {birads_neg}")
                 print(f"Number of occurrences with positive birads: {birads_pos}")
 
+    sys.stdout.close()  # Close the log file and restore stdout to default
+    sys.stdout = sys.__stdout__
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python3 movescu_table.py <excel_table_path>")
+        sys.exit(1)
+
+    process_table(sys.argv[1])
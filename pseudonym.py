@@ -0,0 +1,114 @@
+import os
+import sys
+import hmac
+import hashlib
+import sqlite3
+
+
+PSEUDONYM_TAG = (0x1001, 0x0030)  # private tag holding the deterministic patient pseudonym
+DEFAULT_INDEX_PATH = 'pseudonym_index.sqlite'  # unless PSEUDONYM_INDEX is set, see index_location
+POSTGRES_INDEX = 'postgres'  # index path selecting the pseudonyms table in postgres, shared by all hosts
+INDEX_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS pseudonyms (path TEXT PRIMARY KEY, pseudonym TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS pseudonyms_pseudonym ON pseudonyms (pseudonym)",
+]
+
+
+def load_pseudonym_key():
+    """ Load the HMAC key used for pseudonyms. It has to be different from the Fernet key (AES_KEY) """
+    key = os.getenv('PSEUDONYM_KEY')
+    if key and key == os.getenv('AES_KEY'):
+        raise EnvironmentError("PSEUDONYM_KEY must be different from AES_KEY.")
+    return key
+
+
+def pseudonymize(value, key):
+    """ Deterministic keyed pseudonym (HMAC-SHA256, hex) of a patient identifier.
+        The same PatientID always maps to the same pseudonym, but it cannot be reversed without the key
+    """
+    return hmac.new(key.encode(), str(value).strip().encode(), hashlib.sha256).hexdigest()
+
+
+def index_location(index_path=None):
+    """ index_path, or the PSEUDONYM_INDEX environment variable, or DEFAULT_INDEX_PATH.
+        Read on every call, so a long-running process (the dicomtk daemon) follows the caller's environment
+    """
+    return index_path or os.getenv('PSEUDONYM_INDEX') or DEFAULT_INDEX_PATH
+
+
+def open_index(index_path=None):
+    """ Open (and create if needed) the pseudonym -> paths index: a local SQLite file, or the pseudonyms table in
+        postgres if index_path is 'postgres' (one index for all hosts, used by the encrypt queue workers)
+    """
+    index_path = index_location(index_path)
+    if index_path == POSTGRES_INDEX:
+        import psycopg2
+        from utils import load_db_params
+        conn = psycopg2.connect(**load_db_params())
+        conn.autocommit = True
+    else:
+        # Several local encrypt processes may share the file: wait for each other's writes instead of failing after
+        # sqlite's default 5 s, and let readers run during writes
+        conn = sqlite3.connect(index_path, timeout=60)
+        conn.execute("PRAGMA journal_mode=WAL")
+    for statement in INDEX_SCHEMA:
+        _execute(conn, statement)
+    return conn
+
+
+def _execute(conn, query, params=()):
+    """ Run a query (with ? placeholders) on a SQLite or postgres index and return the cursor """
+    if isinstance(conn, sqlite3.Connection):
+        return conn.execute(query, params)
+    cursor = conn.cursor()
+    cursor.execute(query.replace('?', '%s'), params)
+    return cursor
+
+
+def add_to_index(conn, pseudonym, path):
+    """ Record that the file at path belongs to the patient with the given pseudonym """
+    if isinstance(conn, sqlite3.Connection):
+        query = "INSERT OR REPLACE INTO pseudonyms (path, pseudonym) VALUES (?, ?)"
+    else:
+        query = ("INSERT INTO pseudonyms (path, pseudonym) VALUES (?, ?) "
+                 "ON CONFLICT (path) DO UPDATE SET pseudonym = EXCLUDED.pseudonym")
+    _execute(conn, query, (os.path.abspath(path), pseudonym))
+
+
+def remove_from_index(conn, path):
+    """ Forget the file at path (e.g. after it was decrypted) """
+    _execute(conn, "DELETE FROM pseudonyms WHERE path = ?", (os.path.abspath(path),))
+
+
+def lookup(conn, pseudonym):
+    """ Return all file paths of the patient with the given pseudonym, without decrypting anything """
+    return [row[0] for row in _execute(conn, "SELECT path FROM pseudonyms WHERE pseudonym = ? ORDER BY path",
+                                       (pseudonym,))]
+
+
+def group_paths(conn):
+    """ Group all indexed file paths by patient pseudonym """
+    groups = {}
+    for pseudonym, path in _execute(conn, "SELECT pseudonym, path FROM pseudonyms ORDER BY pseudonym, path"):
+        groups.setdefault(pseudonym, []).append(path)
+    return groups
+
+
+def find_patient(patient_id, index_path=None):
+    """ Print the pseudonym of patient_id and all indexed files of that patient """
+    key = load_pseudonym_key()
+    if not key:
+        raise EnvironmentError("PSEUDONYM_KEY environment variable not set.")
+    patient_pseudonym = pseudonymize(patient_id, key)
+    index = open_index(index_path)
+    print(f"Pseudonym: {patient_pseudonym}")
+    for file_path in lookup(index, patient_pseudonym):
+        print(file_path)
+    index.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        find_patient(*sys.argv[1:3])
+    else:
+        print("Please provide patient ID.")
@@ -16,3 +16,14 @@ def load_env(env_name):
             print("Error: PACS_PORT environment variable is not a valid integer.")
             sys.exit(1)
     return env
+
+
+def load_db_params():
+    """ Load postgres connection parameters (name, user, pass, host, port) from env variables """
+    return {
+        'dbname': load_env('DB_NAME'),
+        'user': load_env('DB_USER'),
+        'password': load_env('DB_PASS'),
+        'host': load_env('DB_HOST'),
+        'port': load_env('DB_PORT')
+    }